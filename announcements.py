@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""announcements.py
+
+The "last chance" announcement of nearly sold out conferences. The
+conferences with 1 to NEARLY_SOLD_OUT seats left are kept in a single
+AnnouncementSet entity, which registrations update only when their
+conference enters or leaves that range. The set is mirrored to
+ANNOUNCEMENT_CACHE, so reading the announcement runs no query and, on a
+warm instance, no RPC at all.
+
+A registration whose set update is lost leaves the set wrong until the
+cron jobs repair it: reconcile() re-checks the members of the set and
+rebuild() recomputes it from all conferences.
+
+"""
+
+from google.appengine.ext import ndb
+
+import caching
+import seats
+from models import AnnouncementSet
+from models import Conference
+
+NEARLY_SOLD_OUT = 5
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+ANNOUNCEMENT_SET_KEY = ndb.Key(AnnouncementSet, 'nearly_sold_out')
+ANNOUNCEMENT_CACHE = caching.TwoTierCache('RECENT_ANNOUNCEMENTS', fresh_time=3600)
+
+
+def nearlySoldOut(seats_left):
+    return 0 < seats_left <= NEARLY_SOLD_OUT
+
+
+def formatAnnouncement(conferences):
+    """Return the announcement for {websafe key: name}, or "" if empty."""
+    if not conferences:
+        return ""
+    return ANNOUNCEMENT_TPL % ', '.join(sorted(conferences.values()))
+
+
+@ndb.transactional
+def _update(changes, replace=False):
+    announcement_set = ANNOUNCEMENT_SET_KEY.get()
+    stored = announcement_set.conferences if announcement_set else None
+    conferences = {} if replace or stored is None else dict(stored)
+    for wsck, name in changes.items():
+        if name is None:
+            conferences.pop(wsck, None)
+        else:
+            conferences[wsck] = name
+    if conferences != stored:
+        AnnouncementSet(key=ANNOUNCEMENT_SET_KEY, conferences=conferences).put()
+    return conferences
+
+
+def _apply(changes, replace=False):
+    """Apply {websafe key: name, or None to remove} to the set and
+    mirror the result."""
+    conferences = _update(changes, replace)
+    ANNOUNCEMENT_CACHE.set('all', conferences)
+    return conferences
+
+
+def rebuild():
+    """Recompute the set from the seats of every conference."""
+    # seat counts live in the seat shards, so aggregate them for every
+    # conference that has seats at all
+    confs = Conference.query(Conference.maxAttendees > 0).fetch()
+    seats_left = seats.getSeatsAvailableMulti(confs)
+    return _apply(dict((conf.key.urlsafe(), conf.name) for conf in confs
+                       if nearlySoldOut(seats_left[conf.key])), replace=True)
+
+
+def reconcile():
+    """Re-check the members of the set, dropping conferences that sold
+    out, freed seats or were deleted, and picking up renames."""
+    announcement_set = ANNOUNCEMENT_SET_KEY.get()
+    if announcement_set is None:
+        return rebuild()
+    changes = dict.fromkeys(announcement_set.conferences)
+    confs = [conf for conf in ndb.get_multi(
+                 [ndb.Key(urlsafe=wsck) for wsck in changes]) if conf]
+    seats_left = seats.getSeatsAvailableMulti(confs)
+    for conf in confs:
+        if nearlySoldOut(seats_left[conf.key]):
+            changes[conf.key.urlsafe()] = conf.name
+    return _apply(changes)
+
+
+def _load():
+    announcement_set = ANNOUNCEMENT_SET_KEY.get()
+    if announcement_set is None:
+        # first read after deploying the set
+        return rebuild()
+    return announcement_set.conferences
+
+
+def getConferences():
+    """Return {websafe key: name} of the nearly sold out conferences."""
+    return ANNOUNCEMENT_CACHE.get('all', _load)
+
+
+def getAnnouncement():
+    return formatAnnouncement(getConferences())
+
+
+def conferencesCreated(confs):
+    """Add the new conferences that start out nearly sold out."""
+    changes = dict((conf.key.urlsafe(), conf.name) for conf in confs
+                   if nearlySoldOut(conf.seatsAvailable or 0))
+    if changes:
+        _apply(changes)
+
+
+def seatsChanged(conf, seats_left):
+    """Record that conf has seats_left seats after a registration or on
+    creation; writes the set only if conf enters or leaves it."""
+    # counts further up can't have crossed the range in one step
+    if seats_left > NEARLY_SOLD_OUT + 1:
+        return
+    wsck = conf.key.urlsafe()
+    member = nearlySoldOut(seats_left)
+    if (wsck in getConferences()) != member:
+        _apply({wsck: conf.name if member else None})
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""attendees.py
+
+Conference rosters from the Registration entities. The full roster is
+exported as CSV to Cloud Storage by a chain of tasks, so neither memory
+nor the request deadline grows with the size of the conference: each
+task writes the next ROSTER_BATCH attendees after its cursor as one part
+object and enqueues the next one, and a retried task rewrites its part
+from the same cursor. The last task composes the parts into one object,
+and a final named task mails the organizer a signed link to it.
+
+Cloud Storage is reached through its JSON API with the app's service
+account, so no client library is needed.
+
+"""
+
+import base64
+import csv
+import json
+import StringIO
+import time
+import urllib
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+from models import Registration
+
+ROSTER_BATCH = 500
+ROSTER_COLUMNS = ('displayName', 'mainEmail', 'teeShirtSize')
+GCS_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+GCS_OBJECTS_URL = 'https://www.googleapis.com/storage/v1/b/%s/o/%s'
+GCS_UPLOAD_URL = ('https://www.googleapis.com/upload/storage/v1/b/%s/o'
+                  '?uploadType=media&name=%s')
+GCS_DEADLINE = 30
+# Cloud Storage composes at most 32 objects per call
+COMPOSE_LIMIT = 32
+LINK_LIFETIME = 7 * 24 * 3600
+
+
+class ExportError(Exception):
+    """A Cloud Storage request of a roster export failed; the task retries."""
+
+
+def attendeesQuery(conf_key):
+    """Return the query for the Registrations of the conference."""
+    return Registration.query(Registration.conference == conf_key)
+
+
+def _bucket():
+    return app_identity.get_default_gcs_bucket_name()
+
+
+def _gcs(method, url, payload=None, content_type=None, missing_ok=False):
+    token, _ = app_identity.get_access_token([GCS_SCOPE])
+    headers = {'Authorization': 'Bearer %s' % token}
+    if content_type:
+        headers['Content-Type'] = content_type
+    resp = urlfetch.fetch(url, method=method, payload=payload, headers=headers,
+                          deadline=GCS_DEADLINE)
+    if resp.status_code == 404 and missing_ok:
+        return
+    if resp.status_code >= 300:
+        raise ExportError('%s %s failed with %d: %s' % (
+            method, url, resp.status_code, resp.content[:200]))
+
+
+def _quote(name):
+    return urllib.quote(name, safe='')
+
+
+def _upload(name, data):
+    _gcs(urlfetch.POST, GCS_UPLOAD_URL % (_bucket(), _quote(name)),
+         payload=data, content_type='text/csv')
+
+
+def _compose(names, destination):
+    _gcs(urlfetch.POST,
+         GCS_OBJECTS_URL % (_bucket(), _quote(destination)) + '/compose',
+         payload=json.dumps({'sourceObjects': [{'name': name} for name in names],
+                             'destination': {'contentType': 'text/csv'}}),
+         content_type='application/json')
+
+
+def _delete(name):
+    _gcs(urlfetch.DELETE, GCS_OBJECTS_URL % (_bucket(), _quote(name)),
+         missing_ok=True)
+
+
+def signedUrl(name, lifetime=LINK_LIFETIME):
+    """Return a URL to download the object for lifetime seconds."""
+    expires = int(time.time()) + lifetime
+    path = '/%s/%s' % (_bucket(), urllib.quote(name))
+    _, signature = app_identity.sign_blob('GET\n\n\n%d\n%s' % (expires, path))
+    return 'https://storage.googleapis.com%s?%s' % (path, urllib.urlencode({
+        'GoogleAccessId': app_identity.get_service_account_name(),
+        'Expires': expires,
+        'Signature': base64.b64encode(signature)}))
+
+
+def rosterName(export_id):
+    return 'rosters/%s/attendees.csv' % export_id
+
+
+def partName(export_id, part):
+    return 'rosters/%s/part-%05d.csv' % (export_id, part)
+
+
+def rosterRows(conf_key, cursor=None):
+    """Return (CSV rows, next cursor or None) of the next ROSTER_BATCH
+    attendees of the conference after cursor."""
+    reg_keys, next_cursor, more = attendeesQuery(conf_key).fetch_page(
+        ROSTER_BATCH, start_cursor=cursor, keys_only=True)
+    # the Profiles are read once, so keep them out of the context cache
+    profs = ndb.get_multi([reg_key.parent() for reg_key in reg_keys],
+                          use_cache=False)
+    rows = [[(getattr(prof, column) or '').encode('utf-8')
+             for column in ROSTER_COLUMNS] for prof in profs if prof]
+    return rows, next_cursor if more else None
+
+
+def _enqueue(export_id, step, params):
+    # named, so a retried chunk doesn't start the rest of the chain twice
+    try:
+        taskqueue.add(name='roster-%s-%s' % (export_id, step),
+                      url='/tasks/export_attendees', params=params)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def startExport(conf_key, email):
+    """Start exporting the roster of the conference for email."""
+    export_id = '%s-%d' % (conf_key.id(), int(time.time() * 1000))
+    _enqueue(export_id, 0, {'websafeConferenceKey': conf_key.urlsafe(),
+                            'email': email, 'exportId': export_id, 'part': 0})
+    return export_id
+
+
+def exportChunk(conf_key, email, export_id, part, cursor=None):
+    """Write part of the export, starting at cursor, and enqueue the next
+    part or, after the last, the task that finishes the export."""
+    rows, next_cursor = rosterRows(conf_key, cursor)
+    out = StringIO.StringIO()
+    writer = csv.writer(out)
+    if part == 0:
+        writer.writerow(ROSTER_COLUMNS)
+    writer.writerows(rows)
+    _upload(partName(export_id, part), out.getvalue())
+
+    params = {'websafeConferenceKey': conf_key.urlsafe(), 'email': email,
+              'exportId': export_id}
+    if next_cursor:
+        params.update(part=part + 1, cursor=next_cursor.urlsafe())
+        _enqueue(export_id, part + 1, params)
+    else:
+        params.update(parts=part + 1)
+        _enqueue(export_id, 'finish', params)
+
+
+def finishExport(conf_key, email, export_id, parts):
+    """Compose the parts of an export into the roster, enqueue the task
+    mailing its link to email and delete the parts."""
+    names = [partName(export_id, part) for part in range(parts)]
+    temporary = list(names)
+    level = 0
+    while len(names) > COMPOSE_LIMIT:
+        composed = []
+        for i in range(0, len(names), COMPOSE_LIMIT):
+            name = 'rosters/%s/compose-%d-%05d.csv' % (export_id, level, i)
+            _compose(names[i:i + COMPOSE_LIMIT], name)
+            composed.append(name)
+        temporary.extend(composed)
+        names = composed
+        level += 1
+    _compose(names, rosterName(export_id))
+
+    # a task of its own, named, so a retry of this one doesn't mail twice
+    _enqueue(export_id, 'mail', {'websafeConferenceKey': conf_key.urlsafe(),
+                                 'email': email, 'exportId': export_id,
+                                 'mail': 1})
+    for name in temporary:
+        _delete(name)
+
+
+def mailExport(conf_key, email, export_id):
+    """Mail email the link to a finished export."""
+    conf = conf_key.get()
+    # the conference may have been deleted while the export ran
+    title = conf.name if conf else 'conference %s' % conf_key.id()
+    mail.send_mail('noreply@%s.appspotmail.com'
+                   % app_identity.get_application_id(),
+                   email,
+                   'Attendees of %s' % title,
+                   'The attendee list of %s is ready for download as CSV '
+                   'for the next %d days:\n\n%s\n'
+                   % (title, LINK_LIFETIME // (24 * 3600),
+                      signedUrl(rosterName(export_id))))
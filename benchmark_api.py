@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""benchmark_api.py
+
+Benchmark of the ConferenceApi methods against the App Engine SDK's
+testbed stubs, so it runs offline. A datastore of configurable size is
+seeded, each method is called --iterations times as a separate request,
+and the latency percentiles, RPC counts per service call and entities
+read per call are printed as JSON, to be diffed between commits.
+
+Latencies are those of the in-process stubs and only comparable between
+runs on the same machine; RPC counts and entities read carry over to
+production. Tasks are queued but not run. With --cold memcache and the
+instance-local caches are flushed before every call.
+
+Needs the App Engine SDK on sys.path.
+
+usage: python benchmark_api.py [options] > before.json
+
+"""
+
+import argparse
+import collections
+import gc
+import json
+import os
+import random
+import sys
+import time
+from datetime import date
+from datetime import time as dtime
+from datetime import timedelta
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+os.environ.setdefault('APPLICATION_ID', 'dev~benchmark')
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from protorpc import message_types
+
+import caching
+import conference
+import registrations
+import search
+import seats
+import speakers
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+from models import ConferenceQueryForm
+from models import ConferenceQueryForms
+from models import Profile
+from models import ProfileMiniForm
+from models import Session
+from models import SessionFilterForm
+from models import SessionForm
+
+AUTH_EMAIL = 'ENDPOINTS_AUTH_EMAIL'
+AUTH_DOMAIN = 'ENDPOINTS_AUTH_DOMAIN'
+CITIES = ('London', 'Paris', 'Chicago', 'Tokyo', 'Berlin', 'Austin',
+          'Toronto', 'Sydney', 'Madrid', 'Seoul')
+TOPICS = ('Web', 'Python', 'Cloud', 'Mobile', 'Data', 'Security',
+          'Design', 'Go')
+SESSION_TYPES = ('Workshop', 'Lecture', 'Keynote', 'Panel')
+SPEAKERS_PER_CONFERENCE = 8
+FIRST_DAY = date(2017, 1, 2)
+
+
+def organizerEmail(i):
+    return 'organizer%d@example.com' % i
+
+
+def userEmail(i):
+    return 'user%d@example.com' % i
+
+
+def setUp():
+    """Activate the testbed stubs the API uses; return the testbed."""
+    bed = testbed.Testbed()
+    bed.activate()
+    # queries see writes immediately, as they do within a request that
+    # wrote them; the benchmark isn't about eventual consistency
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+    bed.init_search_stub()
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    bed.init_urlfetch_stub()
+    bed.init_user_stub()
+    return bed
+
+
+class RpcCounter(object):
+
+    """RpcCounter -- RPCs and entities read, recorded by an apiproxy hook"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = collections.Counter()
+        self.entities_read = 0
+        self.memcache_hits = 0
+
+    def hook(self, service, call, request, response):
+        self.calls['%s.%s' % (service, call)] += 1
+        if service == 'datastore_v3':
+            if call == 'Get':
+                self.entities_read += sum(1 for entity in response.entity_list()
+                                          if entity.has_entity())
+            elif call in ('RunQuery', 'Next'):
+                self.entities_read += response.result_size()
+        elif service == 'memcache' and call == 'Get':
+            self.memcache_hits += response.item_size()
+
+    def install(self):
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark_rpc_counter', self.hook)
+
+
+def seed(args, rng):
+    """Write the conferences, sessions, profiles, registrations and
+    wishlists; return what the scenarios pick from."""
+
+    profiles = [Profile(key=ndb.Key(Profile, userEmail(i)),
+                        displayName='User %d' % i, mainEmail=userEmail(i))
+                for i in range(args.profiles)]
+    organizers = [Profile(key=ndb.Key(Profile, organizerEmail(i)),
+                          displayName='Organizer %d' % i,
+                          mainEmail=organizerEmail(i))
+                  for i in range(args.organizers)]
+    ndb.put_multi(profiles + organizers)
+
+    confs = []
+    for i in range(args.conferences):
+        start = FIRST_DAY + timedelta(days=rng.randrange(365))
+        organizer = organizers[i % len(organizers)]
+        confs.append(Conference(
+            key=ndb.Key(Conference, i + 1, parent=organizer.key),
+            name='Conference %d' % i,
+            description='About %s in %s' % (rng.choice(TOPICS), rng.choice(CITIES)),
+            organizerUserId=organizer.key.id(),
+            topics=rng.sample(TOPICS, 2), city=rng.choice(CITIES),
+            startDate=start, endDate=start + timedelta(days=2),
+            month=start.month, maxAttendees=args.seats,
+            seatsAvailable=args.seats))
+
+    sessions = {}
+    for conf in confs:
+        sessions[conf.key] = [Session(
+            parent=conf.key, name='Session %d' % j,
+            highlights='%s for %s' % (rng.choice(SESSION_TYPES), rng.choice(TOPICS)),
+            speaker='Speaker %d' % rng.randrange(SPEAKERS_PER_CONFERENCE),
+            duration=rng.choice((30, 45, 60, 90)),
+            typeOfSession=[rng.choice(SESSION_TYPES)],
+            date=conf.startDate + timedelta(days=rng.randrange(3)),
+            start_time=dtime(rng.randrange(8, 20), rng.choice((0, 30))),
+            wish_list_count=0) for j in range(args.sessions)]
+
+    regs = []
+    wishes = []
+    taken = collections.Counter()
+    for prof in profiles:
+        for conf in rng.sample(confs, min(args.registrations, len(confs))):
+            regs.append(registrations.newRegistration(prof.key, conf.key))
+            taken[conf.key] += 1
+            for session in rng.sample(sessions[conf.key],
+                                      min(args.wishlist, len(sessions[conf.key]))):
+                session.wish_list_count += 1
+                wishes.append((prof.key, session))
+
+    all_sessions = [session for conf in confs for session in sessions[conf.key]]
+    shards = []
+    for conf in confs:
+        conf.seatsAvailable = max(0, args.seats - taken[conf.key])
+        shards.extend(seats.newShards(conf, conf.seatsAvailable))
+    ndb.put_multi(confs + shards + all_sessions)
+    # session keys are only complete once put
+    ndb.put_multi(regs + [registrations.newWishlistEntry(p_key, session.key)
+                          for p_key, session in wishes])
+
+    for conf in confs:
+        speakers.rebuildIndex(conf.key)
+    search.indexConferences(confs)
+    search.indexSessions(all_sessions)
+    return {'conferences': confs, 'sessions': sessions, 'profiles': len(profiles),
+            'cities': sorted(set(conf.city for conf in confs))}
+
+
+def scenarios(data, rng):
+    """Return (method name, user, request factory) for each benchmarked
+    method; user and factory take the iteration number, user is None for
+    methods that need no sign-in."""
+
+    confs = data['conferences']
+    sessions = data['sessions']
+
+    def container(resource, **kwargs):
+        return resource.combined_message_class(**kwargs)
+
+    def anyConf():
+        return rng.choice(confs)
+
+    def anySession():
+        return rng.choice(sessions[anyConf().key])
+
+    def wsck():
+        return anyConf().key.urlsafe()
+
+    def benchUser(i):
+        return 'bench%d@example.com' % i
+
+    def seededUser(i):
+        return userEmail(i % data['profiles'])
+
+    # each benchmark user registers for and wishlists one fixed conference
+    # and session, so the undo methods have something to undo
+    mutated_conf = confs[0]
+    mutated_session = sessions[mutated_conf.key][0]
+    organizer = mutated_conf.organizerUserId
+
+    return [
+        ('getConference', None,
+         lambda i: container(conference.CONF_GET_REQUEST, websafeConferenceKey=wsck())),
+        ('queryConferences', None,
+         lambda i: ConferenceQueryForms(filters=[ConferenceQueryForm(
+             field='CITY', operator='EQ', value=rng.choice(data['cities']))])),
+        ('queryConferences[city,month,maxAttendees]', None,
+         lambda i: ConferenceQueryForms(filters=[
+             ConferenceQueryForm(field='CITY', operator='EQ',
+                                 value=rng.choice(data['cities'])),
+             ConferenceQueryForm(field='MONTH', operator='GT', value='3'),
+             ConferenceQueryForm(field='MAX_ATTENDEES', operator='GTEQ',
+                                 value='10')])),
+        ('searchConferences', None,
+         lambda i: container(conference.SEARCH_REQUEST, query=rng.choice(TOPICS))),
+        ('getAnnouncement', None, lambda i: message_types.VoidMessage()),
+        ('getConferenceSessions', None,
+         lambda i: container(conference.CONF_SESSIONS_GET_REQUEST,
+                             websafeConferenceKey=wsck())),
+        ('getConferenceSessionsByType', None,
+         lambda i: container(conference.SESSION_TYPE_GET_REQUEST,
+                             websafeConferenceKey=wsck(),
+                             typeOfSession=rng.choice(SESSION_TYPES))),
+        ('getConferenceSessionsByDate', None,
+         lambda i: container(conference.CONF_SESSIONS_GET_REQUEST,
+                             websafeConferenceKey=wsck())),
+        ('getSessionsBySpeaker', None,
+         lambda i: container(conference.SESSION_SPEAKER_GET_REQUEST,
+                             speaker=anySession().speaker)),
+        ('searchSessions', None,
+         lambda i: container(conference.SEARCH_REQUEST,
+                             query=rng.choice(SESSION_TYPES))),
+        ('filterSessions', None,
+         lambda i: SessionFilterForm(websafeConferenceKey=wsck(),
+                                     excludeTypes=['Workshop'],
+                                     startBefore='18:59')),
+        ('getTopSessions', None,
+         lambda i: container(conference.CONF_GET_REQUEST, websafeConferenceKey=wsck())),
+        ('getFeaturedSpeaker', None,
+         lambda i: container(conference.CONF_GET_REQUEST, websafeConferenceKey=wsck())),
+        ('getProfile', seededUser,
+         lambda i: message_types.VoidMessage()),
+        ('saveProfile', seededUser,
+         lambda i: ProfileMiniForm(displayName='User %d' % i)),
+        ('getConferencesToAttend', seededUser,
+         lambda i: container(conference.CONF_LIST_REQUEST)),
+        ('getSessionsInWishlist', seededUser,
+         lambda i: container(conference.WISHLIST_GET_REQUEST)),
+        ('getConferencesCreated', lambda i: organizer,
+         lambda i: container(conference.CONF_LIST_REQUEST)),
+        ('getConferenceAttendees', lambda i: organizer,
+         lambda i: container(conference.CONF_ATTENDEES_GET_REQUEST,
+                             websafeConferenceKey=mutated_conf.key.urlsafe())),
+        ('registerForConference', benchUser,
+         lambda i: container(conference.CONF_GET_REQUEST,
+                             websafeConferenceKey=mutated_conf.key.urlsafe())),
+        ('unregisterFromConference', benchUser,
+         lambda i: container(conference.CONF_GET_REQUEST,
+                             websafeConferenceKey=mutated_conf.key.urlsafe())),
+        ('addSessionToWishlist', benchUser,
+         lambda i: container(conference.SESSION_GET_REQUEST,
+                             websafeSessionKey=mutated_session.key.urlsafe())),
+        ('deleteSessionFromWishlist', benchUser,
+         lambda i: container(conference.SESSION_GET_REQUEST,
+                             websafeSessionKey=mutated_session.key.urlsafe())),
+        ('createConference', lambda i: organizer,
+         lambda i: ConferenceForm(name='Benchmark %d' % i, city='London',
+                                  topics=['Web'], maxAttendees=100,
+                                  startDate='2017-06-01', endDate='2017-06-03')),
+        ('createSession', lambda i: organizer,
+         lambda i: SessionForm(name='Benchmark session %d' % i,
+                               speaker='Speaker 0', duration=30,
+                               typeOfSession=['Lecture'], date='2017-01-02',
+                               start_time='10:00',
+                               websafeConferenceKey=mutated_conf.key.urlsafe())),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def clearLocalCaches():
+    for obj in gc.get_objects():
+        if isinstance(obj, caching.LRUCache):
+            obj.clear()
+
+
+def run(api, name, user, make_request, args, counter):
+    """Call the method args.iterations times; return its report."""
+    method = getattr(api, name.split('[')[0])
+    latencies = []
+    calls = collections.Counter()
+    entities_read = memcache_hits = 0
+    errors = collections.Counter()
+    for i in range(args.iterations):
+        request = make_request(i)
+        os.environ[AUTH_EMAIL] = user(i) if user else ''
+        os.environ[AUTH_DOMAIN] = 'example.com'
+        # every call is a request of its own
+        ndb.get_context().clear_cache()
+        if args.cold:
+            memcache.flush_all()
+            clearLocalCaches()
+        counter.reset()
+        start = time.time()
+        try:
+            method(request)
+        except Exception as e:
+            errors[type(e).__name__] += 1
+        latencies.append((time.time() - start) * 1000)
+        calls.update(counter.calls)
+        entities_read += counter.entities_read
+        memcache_hits += counter.memcache_hits
+
+    latencies.sort()
+    n = float(args.iterations)
+    report = {
+        'latency_ms': dict((label, round(percentile(latencies, fraction), 3))
+                           for label, fraction in (('p50', 0.5), ('p90', 0.9),
+                                                   ('p99', 0.99), ('max', 1.0))),
+        'rpcs_per_call': dict((call, round(count / n, 2))
+                              for call, count in sorted(calls.items())),
+        'entities_read_per_call': round(entities_read / n, 2),
+        # one per logical write with coalescing; more means separate puts
+        'write_rpcs_per_call': round((calls['datastore_v3.Put'] +
+                                      calls['datastore_v3.Delete']) / n, 2),
+        'memcache_hits_per_call': round(memcache_hits / n, 2),
+    }
+    if errors:
+        report['errors'] = dict(errors)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--conferences', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=20,
+                        help='sessions per conference')
+    parser.add_argument('--profiles', type=int, default=200)
+    parser.add_argument('--organizers', type=int, default=5)
+    parser.add_argument('--registrations', type=int, default=3,
+                        help='conferences each profile registers for')
+    parser.add_argument('--wishlist', type=int, default=2,
+                        help='sessions wishlisted per registered conference')
+    parser.add_argument('--seats', type=int, default=1000,
+                        help='seats of each conference')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--cold', action='store_true',
+                        help='flush memcache and local caches before each call')
+    parser.add_argument('--only', action='append', default=[],
+                        help='benchmark only this method; repeatable')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    bed = setUp()
+    try:
+        rng = random.Random(args.seed)
+        start = time.time()
+        data = seed(args, rng)
+        seed_seconds = time.time() - start
+
+        counter = RpcCounter()
+        counter.install()
+        api = ConferenceApi()
+        methods = {}
+        for name, user, make_request in scenarios(data, rng):
+            if args.only and name.split('[')[0] not in args.only:
+                continue
+            methods[name] = run(api, name, user, make_request, args, counter)
+
+        config = dict(vars(args))
+        del config['only']
+        json.dump({'config': config, 'seed_seconds': round(seed_seconds, 2),
+                   'methods': methods},
+                  sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""benchmark_copiers.py
+
+Micro-benchmark of the per-item cost of serializing entities to forms:
+the reflective all_fields()/hasattr copy the API used before versus the
+precompiled copiers in copiers.py. Needs the App Engine SDK on sys.path;
+no datastore is touched.
+
+usage: python benchmark_copiers.py [items]
+
+"""
+
+import os
+import sys
+import timeit
+from datetime import date
+from datetime import time
+
+os.environ.setdefault('APPLICATION_ID', 'dev~benchmark')
+
+from google.appengine.ext import ndb
+
+from copiers import CONFERENCE_COPIER
+from copiers import SESSION_COPIER
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import Session
+from models import SessionForm
+
+
+def reflectiveConferenceCopy(conf):
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    return cf
+
+
+def compiledConferenceCopy(conf):
+    cf = CONFERENCE_COPIER.toForm(conf)
+    cf.websafeKey = conf.key.urlsafe()
+    return cf
+
+
+def reflectiveSessionCopy(session):
+    sf = SessionForm()
+    for field in sf.all_fields():
+        if hasattr(session, field.name):
+            if field.name == 'date':
+                setattr(sf, field.name, str(getattr(session, field.name)))
+            elif field.name == 'start_time':
+                setattr(sf, field.name, str(getattr(session, field.name)))
+            else:
+                setattr(sf, field.name, getattr(session, field.name))
+    sf.websafeKey = session.key.urlsafe()
+    return sf
+
+
+def compiledSessionCopy(session):
+    sf = SESSION_COPIER.toForm(session)
+    sf.websafeKey = session.key.urlsafe()
+    return sf
+
+
+def perItem(copy, entities, repeat=5):
+    """Return the best per-item time in microseconds over repeat runs."""
+    best = min(timeit.repeat(lambda: [copy(e) for e in entities],
+                             number=1, repeat=repeat))
+    return best / len(entities) * 1e6
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    p_key = ndb.Key(Profile, 'organizer@example.com')
+    confs = [Conference(key=ndb.Key(Conference, i + 1, parent=p_key),
+                        name='Conference %d' % i, description='x' * 200,
+                        organizerUserId='organizer@example.com',
+                        topics=['Web', 'Python'], city='London',
+                        startDate=date(2016, 5, 4), endDate=date(2016, 5, 6),
+                        month=5, maxAttendees=100, seatsAvailable=100)
+             for i in range(items)]
+    sessions = [Session(key=ndb.Key(Session, i + 1, parent=confs[0].key),
+                        name='Session %d' % i, highlights='x' * 200,
+                        speaker='Speaker %d' % (i % 50), duration=30,
+                        typeOfSession=['Workshop'], date=date(2016, 5, 4),
+                        start_time=time(9, 30), wish_list_count=0)
+                for i in range(items)]
+
+    for label, reflective, compiled, entities in (
+            ('Conference', reflectiveConferenceCopy, compiledConferenceCopy, confs),
+            ('Session', reflectiveSessionCopy, compiledSessionCopy, sessions)):
+        before = perItem(reflective, entities)
+        after = perItem(compiled, entities)
+        print '%-10s reflective %7.2f us/item  compiled %7.2f us/item  (%.1fx)' % (
+            label, before, after, before / after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""caching.py
+
+Version-stamped read-through cache on top of memcache. Every cached
+value is stored together with the version of its name; writers bump the
+version, which turns all entries stored under an older version into
+misses. A warm read is one memcache get_multi of the version and the
+entry.
+
+Also home of LRUCache, a small instance-local cache used in front of
+memcache for values read on nearly every request, and TwoTierCache,
+which puts one in front of memcache for derived data that is expensive
+to recompute: only the request holding a short memcache lease
+recomputes a missing or stale value, while the others wait for it or
+keep serving the stale one.
+
+"""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+VERSION_KEY = 'VERSION_%s'
+ENTRY_KEY = 'ENTRY_%s'
+# bounds staleness of data that is not invalidated explicitly
+ENTRY_CACHE_TIME = 600
+
+CACHE_KEY = 'CACHE_%s_%s'
+LEASE_KEY = 'LEASE_%s_%s'
+# a lease outlives a recompute that died without releasing it by this long
+LEASE_TIME = 30
+# how long requests without the lease wait for a missing value
+LEASE_POLLS = 20
+LEASE_POLL_INTERVAL = 0.1
+LOCAL_CACHE_TIME = 5
+
+_MISSING = object()
+
+
+class LRUCache(object):
+
+    """LRUCache -- thread safe, size bounded instance-local cache with
+    optional per-entry expiry"""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if missing or expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                return default
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Cache value for key, for ttl seconds if given."""
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TwoTierCache(object):
+
+    """TwoTierCache -- derived values cached per key in an instance-local
+    LRUCache and in memcache, recomputed by one request at a time"""
+
+    def __init__(self, name, fresh_time, stale_time=None, local_size=256,
+                 local_time=LOCAL_CACHE_TIME):
+        self.name = name
+        self.fresh_time = fresh_time
+        # stale values are served while one request recomputes them
+        self.stale_time = fresh_time if stale_time is None else stale_time
+        self.local_time = min(local_time, fresh_time)
+        self.local = LRUCache(local_size)
+
+    def get(self, key, compute):
+        """Return the value for key, calling compute() to produce it when
+        it is missing or stale and this request gets the lease."""
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        cache_key = CACHE_KEY % (self.name, key)
+        entry = memcache.get(cache_key)
+        if entry is not None:
+            value, fresh_until = entry
+            # fresh, or stale while another request refreshes it
+            if fresh_until > time.time() or not self._lease(key):
+                self.local.set(key, value, self.local_time)
+                return value
+            return self._recompute(key, compute)
+
+        if self._lease(key):
+            return self._recompute(key, compute)
+        for _ in range(LEASE_POLLS):
+            time.sleep(LEASE_POLL_INTERVAL)
+            entry = memcache.get(cache_key)
+            if entry is not None:
+                self.local.set(key, entry[0], self.local_time)
+                return entry[0]
+        # the lease holder is slow or died
+        return compute()
+
+    def set(self, key, value):
+        """Store a freshly computed value for key."""
+        memcache.set(CACHE_KEY % (self.name, key),
+                     (value, time.time() + self.fresh_time),
+                     time=self.fresh_time + self.stale_time)
+        self.local.set(key, value, self.local_time)
+
+    def delete(self, key):
+        """Drop the value for key; the next reader recomputes it."""
+        memcache.delete(CACHE_KEY % (self.name, key))
+        self.local.delete(key)
+
+    def _lease(self, key):
+        return memcache.add(LEASE_KEY % (self.name, key), 1, time=LEASE_TIME)
+
+    def _recompute(self, key, compute):
+        try:
+            value = compute()
+            self.set(key, value)
+        finally:
+            memcache.delete(LEASE_KEY % (self.name, key))
+        return value
+
+
+def getVersioned(name, load):
+    """Return the cached value for name, calling load() to compute and
+    cache it when missing or stale."""
+    version_key = VERSION_KEY % name
+    entry_key = ENTRY_KEY % name
+    cached = memcache.get_multi([version_key, entry_key])
+    version = cached.get(version_key)
+    entry = cached.get(entry_key)
+    if version is not None and entry is not None and entry[0] == version:
+        return entry[1]
+
+    value = load()
+    if version is None:
+        # version was never set or got evicted; start from a fresh stamp
+        # so entries cached under the lost version can't come back
+        version = int(time.time() * 1000)
+        if not memcache.add(version_key, version):
+            return value
+    memcache.set(entry_key, (version, value), time=ENTRY_CACHE_TIME)
+    return value
+
+
+def invalidate(name):
+    """Bump the version of name once the current transaction (if any)
+    has committed, making all cached entries for it stale."""
+    # an evicted version restarts from a fresh stamp, so the version moves
+    # forward even then and a reader can't cache data from before the write
+    ndb.get_context().call_on_commit(
+        lambda: memcache.incr(VERSION_KEY % name,
+                              initial_value=int(time.time() * 1000)))
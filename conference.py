@@ -24,10 +24,12 @@ from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
-from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 
+from models import AttendeeForms
 from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
@@ -39,9 +41,13 @@ from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
-from models import TeeShirtSize
 from models import SessionForm
 from models import SessionForms
+from models import SessionGroupForm
+from models import SessionBatchForm
+from models import SessionFilterForm
+from models import SessionResultForm
+from models import SessionResultForms
 from models import Session
 from models import FeaturedSpeakerForm
 from models import FeaturedSpeakerForms
@@ -52,13 +58,37 @@ from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
-from utils import getUserId
+
+import announcements
+import attendees
+import caching
+from copiers import ATTENDEE_COPIER
+from copiers import CONFERENCE_COPIER
+from copiers import PROFILE_COPIER
+from copiers import SESSION_COPIER
+from copiers import formToDict
+import instrumentation
+import leaderboard
+import planner
+import popularity
+import registrations
+import search
+import seats
+import sessionfilter
+import speakers
+import tasks
+import unitofwork
+import usercontext
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
+CONFERENCE_CACHE_KEY = "CONFERENCE_%s"
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# results a filtered page reads at most, however few of them match
+MAX_SCANNED = 5 * MAX_PAGE_SIZE
+GET_MULTI_CHUNK = 500
+BULK_PUT_CHUNK = 100
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -102,6 +132,20 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_ATTENDEES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
 SESSION_POST_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSessionKey=messages.StringField(1),
@@ -112,15 +156,39 @@ SESSION_GET_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1),
 )
 
+CONF_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True),
+)
+
+CONF_SESSIONS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    fields=messages.StringField(4, repeated=True),
+)
+
 SESSION_TYPE_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     typeOfSession=messages.StringField(2),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+    fields=messages.StringField(5, repeated=True),
+)
+
+WISHLIST_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    groupBy=messages.StringField(1),
 )
 
 SESSION_SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    fields=messages.StringField(4, repeated=True),
 )
 
 # - - - - - - - - - 
@@ -132,6 +200,113 @@ def getConferenceByKey(websafeConferenceKey):
         raise endpoints.NotFoundException(
            'No conference found with key: %s' % websafeConferenceKey)
     return conf
+
+def pageSize(request):
+    """Return the request's pageSize, defaulted and capped at MAX_PAGE_SIZE."""
+    if request.pageSize is not None and request.pageSize < 0:
+        raise endpoints.BadRequestException(
+            'Invalid pageSize: %d' % request.pageSize)
+    return min(request.pageSize or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+
+@ndb.tasklet
+def fetchPageAsync(query, request, callback=None, projection=None, keys_only=False,
+                   predicate=None):
+    """Fetch one page of query as selected by the request's pageSize and
+    pageToken in a single pass; return (results, nextPageToken).
+
+    callback, if given, is called with each result as it streams in, so
+    lookups of related entities can start while the page is still being
+    fetched. projection, if given, fetches only those properties.
+    predicate, if given, filters results in memory; the page is filled
+    from at most MAX_SCANNED results, so it may come back short or empty
+    with a nextPageToken to continue after the last result read."""
+    page_size = pageSize(request)
+    cursor = None
+    if request.pageToken:
+        try:
+            cursor = Cursor(urlsafe=request.pageToken)
+        except:
+            raise endpoints.BadRequestException(
+                'Invalid pageToken: %s' % request.pageToken)
+
+    # same approach as ndb's fetch_page: ask for one extra result so we
+    # know whether there is a next page
+    options = {'keys_only': keys_only}
+    if projection:
+        options['projection'] = projection
+    if predicate is None:
+        options.update(limit=page_size + 1, batch_size=page_size)
+    else:
+        options.update(batch_size=MAX_PAGE_SIZE)
+    it = query.iter(start_cursor=cursor, produce_cursors=True, **options)
+    results = []
+    scanned = 0
+    capped = False
+    while (yield it.has_next_async()):
+        result = it.next()
+        scanned += 1
+        if predicate is None or predicate(result):
+            results.append(result)
+            if callback:
+                callback(result)
+            if len(results) >= page_size:
+                break
+        if predicate and scanned >= MAX_SCANNED:
+            capped = True
+            break
+    try:
+        next_cursor = it.cursor_after()
+    except datastore_errors.BadArgumentError:
+        next_cursor = None
+    if next_cursor and (capped or it.probably_has_next()):
+        raise ndb.Return(results, next_cursor.urlsafe())
+    raise ndb.Return(results, None)
+
+def fetchPage(query, request, callback=None, projection=None, keys_only=False,
+              predicate=None):
+    """Synchronous fetchPageAsync. A projection the datastore can't serve,
+    e.g. for lack of a matching index, falls back to full entities."""
+    if projection:
+        try:
+            return fetchPageAsync(query, request, callback, projection,
+                                  predicate=predicate).get_result()
+        except (datastore_errors.NeedIndexError, datastore_errors.BadRequestError) as e:
+            logging.warning('Projection %s failed, fetching entities: %s',
+                            projection, e)
+    return fetchPageAsync(query, request, callback, keys_only=keys_only,
+                          predicate=predicate).get_result()
+
+def searchPage(searcher, request):
+    """Run search.searchConferences or searchSessions for the request's
+    query and page; return (entities in rank order, nextPageToken)."""
+    if not search.tokenize(request.query):
+        raise endpoints.BadRequestException("'query' must contain a word")
+    page_size = pageSize(request)
+    try:
+        keys, next_token = searcher(request.query, page_size, request.pageToken)
+    except ValueError:
+        raise endpoints.BadRequestException(
+            'Invalid pageToken: %s' % request.pageToken)
+    # documents of since deleted entities are skipped
+    return [entity for entity in ndb.get_multi(keys) if entity], next_token
+
+def requestedFields(copier, request):
+    """Return the fields asked for by the request as a frozenset, or None
+    if the full forms are wanted."""
+    try:
+        return copier.checkFields(request.fields)
+    except ValueError as e:
+        raise endpoints.BadRequestException(str(e))
+
+def wants(fields, name):
+    """Whether the response should include the field name."""
+    return fields is None or name in fields
+
+def getMultiChunked(keys):
+    """get_multi for any number of keys; the chunks are fetched concurrently."""
+    futures = [ndb.get_multi_async(keys[i:i + GET_MULTI_CHUNK])
+               for i in range(0, len(keys), GET_MULTI_CHUNK)]
+    return [future.get_result() for chunk in futures for future in chunk]
 #- - - - - - - - - - - - - - - - - - - - -
 
 class UnProcessableException(endpoints.ServiceException):
@@ -148,37 +323,32 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
+    def _copyConferenceToForm(self, conf, displayName, seatsAvailable=None, fields=None):
+        """Copy relevant fields from Conference to ConferenceForm, only
+        those in fields if given."""
+        cf = CONFERENCE_COPIER.toForm(conf, fields)
+        if wants(fields, 'websafeKey'):
+            cf.websafeKey = conf.key.urlsafe()
+        if displayName and wants(fields, 'organizerDisplayName'):
             setattr(cf, 'organizerDisplayName', displayName)
+        # live seat count comes from the seat shards
+        if wants(fields, 'seatsAvailable'):
+            if seatsAvailable is None:
+                seatsAvailable = seats.getSeatsAvailable(conf)
+            cf.seatsAvailable = seatsAvailable
         cf.check_initialized()
         return cf
 
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
+    @staticmethod
+    def _conferenceDataFromForm(request):
+        """Validate a ConferenceForm and return Conference properties
+        without key and organizer."""
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
 
         # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        data = formToDict(request)
         del data['websafeKey']
         del data['organizerDisplayName']
 
@@ -200,6 +370,15 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        return data
+
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # preload necessary data items
+        user_id = usercontext.current().userId()
+
+        data = self._conferenceDataFromForm(request)
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
@@ -208,10 +387,13 @@ class ConferenceApi(remote.Service):
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
+        # create Conference with its seat shards, send email to organizer
+        # confirming creation of Conference & return (modified) ConferenceForm
+        conf = Conference(**data)
+        seats.createWithShards(conf, data['seatsAvailable'])
+        search.indexConferences([conf])
+        announcements.conferencesCreated([conf])
+        taskqueue.add(params={'email': usercontext.current().user().email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
         )
@@ -220,15 +402,11 @@ class ConferenceApi(remote.Service):
     
 
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        """Update the Conference and, when maxAttendees changes, its seat
+        shards by the same number of seats; return (conf, seat change)."""
+        user_id = usercontext.current().userId()
 
         # update existing conference
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
@@ -242,26 +420,43 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # seats are taken from the shards by registrations only
+        if request.seatsAvailable is not None:
+            raise endpoints.BadRequestException(
+                'seatsAvailable can\'t be updated; change maxAttendees instead')
+        delta = 0
+        shards = []
+        if request.maxAttendees is not None:
+            delta = request.maxAttendees - (conf.maxAttendees or 0)
+            if delta:
+                shards = seats.resizeShards(conf, delta)
+                if shards is None:
+                    raise ConflictException(
+                        'maxAttendees can\'t drop below the registered attendees')
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
-        for field in request.all_fields():
-            data = getattr(request, field.name)
+        for name, data in formToDict(request).items():
             # only copy fields where we get data
-            if data not in (None, []):
+            if data not in (None, []) and name in Conference._properties:
                 # special handling for dates (convert string to Date)
-                if field.name in ('startDate', 'endDate'):
+                if name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
-                    if field.name == 'startDate':
+                    if name == 'startDate':
                         conf.month = data.month
                 # write to Conference object
-                setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+                setattr(conf, name, data)
+        # the stored count is only a snapshot; the shards hold the live one
+        conf.seatsAvailable = max(0, (conf.seatsAvailable or 0) + delta)
+        ndb.put_multi([conf] + shards)
+        caching.invalidate(CONFERENCE_CACHE_KEY % conf.key.urlsafe())
+        search.indexConferences([conf])
+        return conf, delta
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @usercontext.withUserContext
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -270,9 +465,19 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @usercontext.withUserContext
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        conf = getConferenceByKey(request.websafeConferenceKey)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        seats.ensureShards(conf)
+        conf, delta = self._updateConferenceObject(request)
+        if delta:
+            self._seatsChanged(conf, delta)
+        prof = usercontext.current().profile()
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
@@ -280,57 +485,83 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = getConferenceByKey(request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        wsck = request.websafeConferenceKey
+
+        def load():
+            # get Conference object from request; bail if not found
+            conf = getConferenceByKey(wsck)
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % wsck)
+            prof = conf.key.parent().get()
+            return conf, getattr(prof, 'displayName', None), seats.getSeatsAvailable(conf)
+
+        # conference, organizer name and seats are cached together, so a
+        # warm detail view is a single memcache batch get
+        conf, displayName, seatsAvailable = caching.getVersioned(
+            CONFERENCE_CACHE_KEY % wsck, load)
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return self._copyConferenceToForm(conf, displayName, seatsAvailable)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_LIST_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @usercontext.withUserContext
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
+        fields = requestedFields(CONFERENCE_COPIER, request)
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = usercontext.current().userId()
 
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        query = Conference.query(ancestor=ndb.Key(Profile, user_id))
+        projection = fields and CONFERENCE_COPIER.projection(fields)
+        confs = None
+        if projection:
+            try:
+                confs = query.fetch(projection=projection)
+            except (datastore_errors.NeedIndexError, datastore_errors.BadRequestError) as e:
+                logging.warning('Projection %s failed, fetching entities: %s',
+                                projection, e)
+        if confs is None:
+            confs = query.fetch()
+        prof = usercontext.current().profile()
+        seatsAvailable = {}
+        if wants(fields, 'seatsAvailable'):
+            seatsAvailable = seats.getSeatsAvailableMulti(confs)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName'),
+                seatsAvailable.get(conf.key), fields) for conf in confs]
         )
 
 
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+        """Return formatted query from the submitted filters, and the plan
+        whose in-memory filters the results must still pass."""
+        filters = self._formatFilters(request.filters)
+        query_plan = planner.plan(filters)
+        logging.info(planner.logLine(filters, query_plan))
 
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
+        # If exists, sort on the served inequality filter first
+        q = Conference.query()
+        if query_plan.inequality_field:
+            q = q.order(ndb.GenericProperty(query_plan.inequality_field))
+        q = q.order(Conference.name)
 
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
+        for filtr in query_plan.served:
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
-        return q
+        # order on key last so pages break between equal names
+        return q.order(Conference.key), query_plan
 
 
     def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
+        """Parse, check validity and format user supplied filters. Any
+        combination is allowed; the planner decides which filters the
+        datastore runs."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
@@ -341,18 +572,15 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter value for %s must be a number." % filtr["field"])
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
@@ -361,22 +589,62 @@ class ConferenceApi(remote.Service):
             name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        fields = requestedFields(CONFERENCE_COPIER, request)
+        query, query_plan = self._getQuery(request)
+        # properties with an equality filter can't be projected, and the
+        # in-memory filters need their properties
+        projection = fields and CONFERENCE_COPIER.projection(
+            frozenset(fields | set(f["field"] for f in query_plan.post)),
+            exclude=[f["field"] for f in query_plan.served if f["operator"] == "="])
+
+        # need to fetch organiser displayName from profiles; start each
+        # lookup as soon as its conference streams in, ndb batches the
+        # pending gets into get_multi RPCs that overlap the query itself.
+        # The organiser is the parent of the conference key, which is
+        # there even if organizerUserId wasn't projected.
+        organisers = {}
+        def getOrganiser(conf):
+            p_key = conf.key.parent()
+            if p_key not in organisers:
+                organisers[p_key] = p_key.get_async()
+        conferences, next_token = fetchPage(
+            query, request,
+            getOrganiser if wants(fields, 'organizerDisplayName') else None,
+            projection,
+            predicate=query_plan.matches if query_plan.post else None)
 
         # put display names in a dict for easier fetching
         names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        for p_key, future in organisers.items():
+            names[p_key] = getattr(future.get_result(), 'displayName', None)
+
+        seatsAvailable = {}
+        if wants(fields, 'seatsAvailable'):
+            seatsAvailable = seats.getSeatsAvailableMulti(conferences)
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+                items=[self._copyConferenceToForm(conf, names.get(conf.key.parent()),
+                seatsAvailable.get(conf.key), fields) for conf in conferences],
+                nextPageToken=next_token
+        )
+
+
+    @endpoints.method(SEARCH_REQUEST, ConferenceForms,
+            path='searchConferences',
+            http_method='GET',
+            name='searchConferences')
+    def searchConferences(self, request):
+        """Search conferences by words in their name, description, city
+        and topics; best matches first."""
+        conferences, next_token = searchPage(search.searchConferences, request)
+        organisers = ndb.get_multi(list(set(conf.key.parent() for conf in conferences)))
+        names = dict((prof.key, prof.displayName) for prof in organisers if prof)
+        seatsAvailable = seats.getSeatsAvailableMulti(conferences)
+        return ConferenceForms(
+                items=[self._copyConferenceToForm(conf, names.get(conf.key.parent()),
+                seatsAvailable[conf.key]) for conf in conferences],
+                nextPageToken=next_token
         )
 
 
@@ -385,48 +653,43 @@ class ConferenceApi(remote.Service):
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
         # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
+        conf_keys = registrations.conferenceKeysAsync(prof.key)
+        session_keys = registrations.sessionKeysAsync(prof.key)
+        pf = PROFILE_COPIER.toForm(prof)
+        pf.conferenceKeysToAttend = [key.urlsafe() for key in conf_keys.get_result()]
+        pf.sessionKeysInWishlist = [key.urlsafe() for key in session_keys.get_result()]
         pf.check_initialized()
         return pf
 
 
-    def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+    def _getProfileFromUser(self, forUpdate=False):
+        """Return user Profile from datastore, creating new one if non-existent;
+        resolved once per request by the request's UserContext."""
+        return usercontext.current().profile(forUpdate)
+
+
+    def _migrateProfile(self):
+        """Move keys left in the user's repeated Profile properties into
+        Registration and WishlistEntry entities."""
+        if registrations.hasLegacy(self._getProfileFromUser()):
+            self._migrateProfileTxn()
 
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
-        if not profile:
-            profile = Profile(
-                key = p_key,
-                displayName = user.nickname(),
-                mainEmail= user.email(),
-                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
 
-        return profile      # return Profile
+    @ndb.transactional
+    def _migrateProfileTxn(self):
+        prof = self._getProfileFromUser(forUpdate=True)
+        if registrations.hasLegacy(prof):
+            ndb.put_multi(registrations.migrate(prof) + [prof])
 
 
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
+        self._migrateProfile()
         prof = self._getProfileFromUser()
 
         # if saveProfile(), process user-modifyable fields
+        uow = unitofwork.current()
         if save_request:
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
@@ -437,14 +700,17 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-                        prof.put()
+                        uow.put(prof)
 
-        # return ProfileForm
+        # the Profile is written while the form is built
+        uow.flushAsync()
         return self._copyProfileToForm(prof)
 
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @usercontext.withUserContext
+    @unitofwork.withUnitOfWork
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -452,6 +718,8 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @usercontext.withUserContext
+    @unitofwork.withUnitOfWork
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -459,87 +727,49 @@ class ConferenceApi(remote.Service):
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
-    @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
-
-
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement of the nearly sold out conferences."""
+        return StringMessage(data=announcements.getAnnouncement())
 
 # - - - Sessions - - - - - - - - - - - - - - - - - - - - - 
     
 
-    def _copySessionToForm(self, session):
-        """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(session, field.name):
-                # convert Date to date string;
-                if field.name == 'date':
-                    setattr(sf, field.name, str(getattr(session, field.name)))
-                # convert start_time to time string;
-                elif field.name == 'start_time':
-                    setattr(sf, field.name, str(getattr(session, field.name)))
-                # convert websafeKey to urlsafe value;
-                elif field.name == "websafeKey":
-                    setattr(sf, field.name, session.key.urlsafe())
-                # copy other fields
-                else:
-                    setattr(sf, field.name, getattr(session, field.name))
+    def _copySessionToForm(self, session, fields=None):
+        """Copy relevant fields from Session to SessionForm, only those in
+        fields if given."""
+        sf = SESSION_COPIER.toForm(session, fields)
+        if wants(fields, 'websafeKey'):
+            sf.websafeKey = session.key.urlsafe()
         #Checks that all required fields are initialized. 
         #Raises a ValidationError if the Message object is not initialized.
         sf.check_initialized() 
         return sf
     
-    def _createSessionObject(self, request):
-        """Create or update Session object, returning request."""
-        wsck = request.websafeConferenceKey
-
+    def _getOwnedConference(self, wsck, action='create sessions for'):
+        """Return the conference, checking the current user organizes it."""
         # preload necessary data items
         conf = getConferenceByKey(wsck)
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-        
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        user_id = usercontext.current().userId()
+
         # check in current user is authorized to add sessions
         if conf.organizerUserId != user_id:
-            raise endpoints.ForbiddenException('Unauthorized to create sessions for %s conference' % conf.name)
+            raise endpoints.ForbiddenException('Unauthorized to %s %s conference' % (action, conf.name))
+        return conf
+
+    def _sessionDataFromForm(self, request, conf):
+        """Validate a SessionForm and return Session properties without key."""
         # check if name exists
         if not request.name:
-            raise endpoints.UnProcessableException("Session 'name' field required")
-        # check if name is unique
-        if Session.query(ancestor=conf.key).filter(Session.name == request.name).get():
-            raise endpoints.BadRequestException("Duplicate session name already exists")
-
+            raise UnProcessableException("Session 'name' field required")
 
         # copy SessionForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        data = formToDict(request)
         del data['websafeConferenceKey']
         del data['websafeKey']
 
@@ -565,43 +795,128 @@ class ConferenceApi(remote.Service):
                  raise UnProcessableException('Incorrect time format or data')
         
         data['wish_list_count'] = 0
+        return data
+
+    def _createSessionObject(self, request):
+        """Create or update Session object, returning request."""
+        conf = self._getOwnedConference(request.websafeConferenceKey)
+        data = self._sessionDataFromForm(request, conf)
+
         c_key = conf.key
         s_id = Session.allocate_ids(size=1, parent=c_key)[0]
         s_key = ndb.Key(Session, s_id, parent=c_key)
         data['key'] = s_key
         
-        # create Session
-        Session(**data).put()
-        
-        # update featured speaker list
-        taskqueue.add(params={'websafeConferenceKey': wsck},
-            url='/tasks/featured_speakers')
+        # create Session and update featured speaker list
+        self._storeSession(Session(**data))
 
         return request
 
+    def _createSessionObjects(self, request):
+        """Create many sessions of one conference at once, returning the
+        outcome of every item; invalid items don't fail the batch."""
+        conf = self._getOwnedConference(request.websafeConferenceKey)
+        results = [SessionResultForm(index=i) for i in range(len(request.items))]
+
+        # validate everything up front; the speaker index knows the names
+        # of all existing sessions, and is checked again as each chunk is
+        # written
+        index = speakers.indexKey(conf.key).get() or speakers.rebuildIndex(conf.key)
+        names = speakers.sessionNames(index)
+        valid = []
+        for i, form in enumerate(request.items):
+            try:
+                data = self._sessionDataFromForm(form, conf)
+                if form.name in names:
+                    raise endpoints.BadRequestException("Duplicate session name already exists")
+            except endpoints.ServiceException as e:
+                results[i].error = str(e)
+                continue
+            names.add(form.name)
+            valid.append((i, data))
+        if not valid:
+            return SessionResultForms(items=results)
+
+        # allocate all ids as one range and write in chunks
+        first, last = Session.allocate_ids(size=len(valid), parent=conf.key)
+        for start in range(0, len(valid), BULK_PUT_CHUNK):
+            chunk = []
+            for offset, (i, data) in enumerate(valid[start:start + BULK_PUT_CHUNK]):
+                data['key'] = ndb.Key(Session, first + start + offset, parent=conf.key)
+                chunk.append((i, Session(**data)))
+            try:
+                stored = self._storeSessionChunk(
+                    conf.key, [session for i, session in chunk])
+            except Exception as e:
+                logging.exception('Bulk session import failed for a chunk')
+                for i, session in chunk:
+                    results[i].error = 'Write failed: %s' % e
+                continue
+            search.indexSessions(stored)
+            for i, session in chunk:
+                if session in stored:
+                    results[i].websafeKey = session.key.urlsafe()
+                else:
+                    results[i].error = 'Duplicate session name already exists'
+        return SessionResultForms(items=results)
+
+    @ndb.transactional()
+    def _storeSessionChunk(self, c_key, sessions):
+        """Put new sessions and record them in the speaker index in one
+        transaction, so concurrent creates can't both take a name; return
+        the sessions stored, without those whose name was taken meanwhile."""
+        names = speakers.sessionNames(speakers.indexKey(c_key).get())
+        stored = [session for session in sessions if session.name not in names]
+        if stored:
+            ndb.put_multi(stored + [speakers.addSessions(c_key, stored)])
+        return stored
+
+    @ndb.transactional()
+    def _storeSession(self, session):
+        """Put a new session and record it in the conference's speaker
+        index; both live in the conference's entity group."""
+        c_key = session.key.parent()
+        # check if name is unique
+        if Session.query(ancestor=c_key).filter(Session.name == session.name).get():
+            raise endpoints.BadRequestException("Duplicate session name already exists")
+        ndb.put_multi([session, speakers.addSessions(c_key, [session])])
+        search.indexSessions([session])
+
     @staticmethod
     def _rankSessions(websafeConferenceKey):
+        """Rebuild the conference's leaderboard from a full session scan and
+        return the top sessions; wishlist changes keep it up to date after."""
         conf = getConferenceByKey(websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key).order(Session.wish_list_count).fetch(5)
-        memcache.set('TOP_SESSIONS_FOR_%s' % conf.name, sessions)
-        return sessions
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % websafeConferenceKey)
+        # rank on live wishlist counts, including deltas not folded yet
+        sessions = Session.query(ancestor=conf.key).fetch()
+        counts = popularity.getWishlistCountsMulti(sessions)
+        leaderboard.storeBoard(conf.key, dict(
+            (session.key.urlsafe(), counts[session.key]) for session in sessions))
+        sessions.sort(key=lambda session: (-counts[session.key], session.key.urlsafe()))
+        return sessions[:leaderboard.TOP_SESSIONS]
+
+    @staticmethod
+    def _topSessionKeys(c_key):
+        """Return the websafe keys of the top sessions from the leaderboard,
+        rebuilding it if it is missing or can't tell."""
+        wssks = leaderboard.getTopSessionKeys(c_key)
+        if wssks is None:
+            wssks = [session.key.urlsafe() for session in
+                     ConferenceApi._rankSessions(c_key.urlsafe())]
+        return wssks
 
     @staticmethod
     def _featuredSpeakers(websafeConferenceKey):
-        sas = {} #SpeakersAndSessions
+        """Rebuild the speaker index of a conference from a full session
+        scan; only needed for conferences predating the index."""
         conf = getConferenceByKey(websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key)
-        for session in sessions:
-            if sas.has_key(session.speaker):
-                sas[session.speaker].append(session.name)
-            else:
-                sas[session.speaker]=[session.name]
-        keys = sas.keys()
-        for key in keys: #remove speakers from list if they have less than two sessions
-            if len(sas[key]) < 2:
-                del sas[key]
-        memcache.set('FEATURED_SPEAKERS_FOR_%s' % conf.name, sas)
-        return sas
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % websafeConferenceKey)
+        return speakers.featuredSpeakers(speakers.rebuildIndex(conf.key))
 
 
     def _copyFeaturedSpeakersToForm(self, speaker, sessions):
@@ -614,15 +929,18 @@ class ConferenceApi(remote.Service):
         return fsf
         
 #TODO getConferenceSessions
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(CONF_SESSIONS_GET_REQUEST, SessionForms,
             path='get_sessions/{websafeConferenceKey}',
             http_method='GET', name='getSessions')
     def getConferenceSessions(self, request):
         """Return sessions for conference."""
+        fields = requestedFields(SESSION_COPIER, request)
         conf = getConferenceByKey(request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key)
+        sessions, next_token = fetchPage(Session.query(ancestor=conf.key), request,
+            projection=fields and SESSION_COPIER.projection(fields))
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
+            items=[self._copySessionToForm(session, fields) for session in sessions],
+            nextPageToken=next_token
         )
 
 #TODO getConferenceSessionsByType
@@ -632,10 +950,15 @@ class ConferenceApi(remote.Service):
             name='getConferenceSessionsByType')
     def getConferenceSessionsByType(self, request):
         """Return all conference sessions of specified type."""
+        fields = requestedFields(SESSION_COPIER, request)
         conf = getConferenceByKey(request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key).filter(Session.typeOfSession == request.typeOfSession)
+        sessions, next_token = fetchPage(Session.query(ancestor=conf.key).filter(
+            Session.typeOfSession == request.typeOfSession), request,
+            projection=fields and SESSION_COPIER.projection(
+                fields, exclude=['typeOfSession']))
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=[self._copySessionToForm(session, fields) for session in sessions],
+            nextPageToken=next_token)
 
 #TODO Create addtional queries
     @endpoints.method(CONF_GET_REQUEST, SessionForms,
@@ -645,33 +968,51 @@ class ConferenceApi(remote.Service):
     def getTopSessions(self, request):
         """Return top five conference sessions based on the number of adds to wish lists."""
         wsck = request.websafeConferenceKey
-        conf = getConferenceByKey(wsck)
-        sessions = memcache.get('TOP_SESSIONS_FOR_%s' % conf.name)
-        if not sessions:
-            taskqueue.add(params={'websafeConferenceKey': wsck},
-            url='/tasks/rank_sessions')
-            sessions = ConferenceApi._rankSessions(wsck)
+        try:
+            c_key = ndb.Key(urlsafe=wsck)
+        except:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        # served from the leaderboard; if it is missing one request
+        # rebuilds it while the others wait
+        wssks = leaderboard.TOP_SESSIONS_CACHE.get(
+            wsck, lambda: ConferenceApi._topSessionKeys(c_key))
+        sessions = [session for session in
+                    ndb.get_multi([ndb.Key(urlsafe=wssk) for wssk in wssks])
+                    if session]
         return SessionForms(
             items=[self._copySessionToForm(session) for session in sessions])
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(CONF_SESSIONS_GET_REQUEST, SessionForms,
             path='get_sessions_by_date/{websafeConferenceKey}',
             http_method='GET',
             name='getConferenceSessionsByDate')
     def getConferenceSessionsByDate(self, request):
         """Given a conference key, return all the sessions organized by session date and time."""
+        fields = requestedFields(SESSION_COPIER, request)
         conf = getConferenceByKey(request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key).order(Session.date).order(Session.start_time)
+        sessions, next_token = fetchPage(Session.query(ancestor=conf.key).order(
+            Session.date).order(Session.start_time), request,
+            projection=fields and SESSION_COPIER.projection(fields))
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=[self._copySessionToForm(session, fields) for session in sessions],
+            nextPageToken=next_token)
 
 #TODO createSession
     @endpoints.method(SessionForm, SessionForm, path='session',
             http_method='POST', name='createSession')
+    @usercontext.withUserContext
     def createSession(self, request):
         """Create new session."""
         return self._createSessionObject(request)
 
+    @endpoints.method(SessionBatchForm, SessionResultForms, path='sessions',
+            http_method='POST', name='createSessions')
+    @usercontext.withUserContext
+    def createSessions(self, request):
+        """Create many sessions of one conference in one call."""
+        return self._createSessionObjects(request)
+
 #TODO getSessionsBySpeaker 
     @endpoints.method(SESSION_SPEAKER_GET_REQUEST, SessionForms,
             path='get_sessions_by_speaker/{speaker}',
@@ -679,14 +1020,32 @@ class ConferenceApi(remote.Service):
             name='getSessionsBySpeaker')
     def getSessionsBySpeaker(self, request):
         """Return sessions across all conferences with specified speaker."""
-        sessions = Session.query().filter(Session.speaker == request.speaker)
+        fields = requestedFields(SESSION_COPIER, request)
+        sessions, next_token = fetchPage(
+            Session.query().filter(Session.speaker == request.speaker), request,
+            projection=fields and SESSION_COPIER.projection(
+                fields, exclude=['speaker']))
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=[self._copySessionToForm(session, fields) for session in sessions],
+            nextPageToken=next_token)
+
+    @endpoints.method(SEARCH_REQUEST, SessionForms,
+            path='searchSessions',
+            http_method='GET',
+            name='searchSessions')
+    def searchSessions(self, request):
+        """Search sessions by words in their name, speaker, type and
+        highlights; best matches first."""
+        sessions, next_token = searchPage(search.searchSessions, request)
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token)
 
 #TODO addSessionToWishlist
     @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
             path='add_session_to_wishlist/{websafeSessionKey}',
             http_method='POST', name='addSessionToWishlist')
+    @usercontext.withUserContext
     def addSessionToWishlist(self, request):
         """Add session to user's wish list"""
         return self._sessionToWishlist(request)
@@ -694,21 +1053,55 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
             path='remove_session_from_wishlist/{websafeSessionKey}',
             http_method='POST', name='deleteSessionFromWishlist')
+    @usercontext.withUserContext
     def deleteSessionFromWishlist(self, request):
         """Delete session from user's wish list"""
         return self._sessionToWishlist(request, add=False)  
 
 #TODO getSessionsInWishlist
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(WISHLIST_GET_REQUEST, SessionForms,
             path='get_wish_list_sessions',
             http_method='GET',
             name='getSessionsInWishlist')
+    @usercontext.withUserContext
     def getSessionsInWishlist(self, request):
-        """Return sessions in users wishlist"""
-        prof = self._getProfileFromUser() # get user Profile
-        sessions = [ndb.Key(urlsafe=sk).get() for sk in prof.sessionKeysInWishlist]
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+        """Return sessions in users wishlist, ordered by date and time.
+
+        With groupBy 'date' or 'conference' the sessions are returned as
+        an agenda in groups instead of items."""
+        if request.groupBy not in (None, '', 'date', 'conference'):
+            raise endpoints.BadRequestException(
+                "groupBy must be 'date' or 'conference'")
+        self._migrateProfile()
+        p_key = usercontext.current().profileKey()
+
+        # skip sessions that no longer exist
+        keys = registrations.sessionKeysAsync(p_key).get_result()
+        sessions = [session for session in getMultiChunked(keys) if session]
+        sessions.sort(key=lambda session: (session.date, session.start_time))
+
+        if not request.groupBy:
+            return SessionForms(
+                items=[self._copySessionToForm(session) for session in sessions])
+
+        # groups are ordered by their earliest session
+        groups = []
+        byKey = {}
+        if request.groupBy == 'conference':
+            conf_keys = list(set(session.key.parent() for session in sessions))
+            confs = dict(zip(conf_keys, getMultiChunked(conf_keys)))
+        for session in sessions:
+            if request.groupBy == 'date':
+                key = name = str(session.date)
+            else:
+                conf = confs[session.key.parent()]
+                key = session.key.parent().urlsafe()
+                name = getattr(conf, 'name', None)
+            if key not in byKey:
+                byKey[key] = SessionGroupForm(key=key, name=name)
+                groups.append(byKey[key])
+            byKey[key].items.append(self._copySessionToForm(session))
+        return SessionForms(groups=groups)
 
 #TODO getFeaturedSpeaker
     @endpoints.method(CONF_GET_REQUEST, FeaturedSpeakerForms,
@@ -718,20 +1111,52 @@ class ConferenceApi(remote.Service):
     def getFeaturedSpeaker(self, request):
         """For a given conference return the featured speakers, those speaking twice"""
         wsck = request.websafeConferenceKey
-        conf = getConferenceByKey(wsck)
-        fspeakers = memcache.get('FEATURED_SPEAKERS_FOR_%s' % conf.name)
-        if not fspeakers:
-            taskqueue.add(params={'websafeConferenceKey': wsck},
-            url='/tasks/featured_speakers')
-            fspeakers = self._featuredSpeakers(wsck)
-            #raise endpoints.NotFoundException(
-            #    'Featured speaker list is temporarily unavailable, please try again later')
-        
+        try:
+            c_key = ndb.Key(urlsafe=wsck)
+        except:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        # answered from the speaker index
+        fspeakers = speakers.getFeaturedSpeakers(c_key)
+        if fspeakers is None:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
         return FeaturedSpeakerForms(
             items=[self._copyFeaturedSpeakersToForm(key, fspeakers[key]) for key in fspeakers.keys()])
         
 
-#TODO Solve the following query related problem
+    def _sessionFilter(self, request):
+        """Return the SessionFilter of a SessionFilterForm."""
+        try:
+            return sessionfilter.SessionFilter(request)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+
+    @endpoints.method(SessionFilterForm, SessionForms,
+            path='filterSessions',
+            http_method='POST',
+            name='filterSessions')
+    def filterSessions(self, request):
+        """Return sessions, of one conference if given, matching all of the
+        type, start time, date, duration and speaker constraints."""
+        session_filter = self._sessionFilter(request)
+        conf_key = None
+        if request.websafeConferenceKey:
+            conf = getConferenceByKey(request.websafeConferenceKey)
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s'
+                    % request.websafeConferenceKey)
+            conf_key = conf.key
+        sessions, next_token = fetchPage(session_filter.query(conf_key), request,
+                                         predicate=session_filter.matches)
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token)
+
+
     @endpoints.method(CONF_GET_REQUEST, SessionForms,
             path='non_workshops_before_7PM/{websafeConferenceKey}',
             http_method='GET',
@@ -739,21 +1164,70 @@ class ConferenceApi(remote.Service):
     def getNonWorkshopBefore7PM(self, request):
         """Return non workshop sessions before 7PM"""
         conf = getConferenceByKey(request.websafeConferenceKey)
-        sessions = Session.query(ancestor = conf.key).filter(Session.typeOfSession != 'Workshop')
-        items = []
-        for session in sessions:
-            if session.start_time.hour < 19:
-                items.append(self._copySessionToForm(session))
-        return SessionForms(items=items)    
+        session_filter = self._sessionFilter(SessionFilterForm(
+            excludeTypes=['Workshop'], startBefore='18:59'))
+        items = [self._copySessionToForm(session)
+                 for session in session_filter.query(conf.key)
+                 if session_filter.matches(session)]
+        return SessionForms(items=items)
     
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
     @ndb.transactional(xg=True)
+    def _claimSeat(self, conf_key, shard_key):
+        """Register user and take one seat from the given shard; return
+        False without writing if the shard has no seats left."""
+        p_key = usercontext.current().profileKey()
+        reg_key = registrations.registrationKey(p_key, conf_key.urlsafe())
+
+        # check if user already registered otherwise add
+        reg, shard = ndb.get_multi([reg_key, shard_key])
+        if reg:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if not shard or shard.seats <= 0:
+            return False
+
+        # register user, take away one seat
+        shard.seats -= 1
+        with unitofwork.UnitOfWork() as uow:
+            uow.put(registrations.newRegistration(p_key, conf_key), shard)
+        return True
+
+
+    @ndb.transactional(xg=True)
+    def _releaseSeat(self, conf_key, shard_key):
+        """Unregister user and give one seat back to the given shard."""
+        p_key = usercontext.current().profileKey()
+        reg_key = registrations.registrationKey(p_key, conf_key.urlsafe())
+
+        # check if user already registered
+        reg, shard = ndb.get_multi([reg_key, shard_key])
+        if not reg:
+            return False
+
+        # unregister user, add back one seat
+        shard.seats += 1
+        with unitofwork.UnitOfWork() as uow:
+            uow.delete(reg_key)
+            uow.put(shard)
+        return True
+
+
+    def _seatsChanged(self, conf, delta):
+        """Propagate a committed seat change to the caches and, when it
+        crosses the nearly sold out threshold, the announcement."""
+        seats_left = seats.adjustCachedSeats(conf, delta)
+        if seats_left is None:
+            seats_left = seats.getSeatsAvailable(conf)
+        caching.invalidate(CONFERENCE_CACHE_KEY % conf.key.urlsafe())
+        announcements.seatsChanged(conf, seats_left)
+
+
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
-        prof = self._getProfileFromUser() # get user Profile
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
@@ -762,118 +1236,123 @@ class ConferenceApi(remote.Service):
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        conf = seats.ensureShards(conf)
+        self._migrateProfile()
 
-        # register
+        # register; each attempt is a small transaction on the user's
+        # Registration and a single seat shard, so registrations for one
+        # conference don't contend on the Conference entity group
         if reg:
-            # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
-                raise ConflictException(
-                    "You have already registered for this conference")
-
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
+            for shard_key in seats.shardsToTry(conf):
+                retval = self._claimSeat(conf.key, shard_key)
+                if retval:
+                    break
+            else:
                 raise ConflictException(
                     "There are no seats available.")
-
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
+            self._seatsChanged(conf, -1)
 
         # unregister
         else:
-            # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            retval = self._releaseSeat(conf.key, seats.randomShard(conf))
+            if retval:
+                self._seatsChanged(conf, 1)
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
+        return BooleanMessage(data=retval)
+
+    @ndb.transactional(xg=True)
+    def _toggleWishlist(self, session_key, add):
+        """Add or remove the session in the user's wishlist and record the
+        count change on a wishlist shard; return the count delta."""
+        p_key = usercontext.current().profileKey()
+        entry_key = registrations.wishlistKey(p_key, session_key.urlsafe())
+        entry = entry_key.get()
+
+        with unitofwork.UnitOfWork() as uow:
+            # register
+            if add:
+                # check if session is already in wish list
+                if entry:
+                    raise ConflictException(
+                        "You have already added this session to your wishlist")
+                uow.put(registrations.newWishlistEntry(p_key, session_key))
+                delta = 1
+            # unregister
             else:
-                retval = False
+                if not entry:
+                    raise ConflictException(
+                        "This session does not exist in your wishlist")
+                uow.delete(entry_key)
+                delta = -1
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+            # write things back to the datastore; the Session itself is only
+            # written when the shard deltas are folded in
+            uow.put(popularity.applyDelta(session_key, delta))
+        return delta
 
     def _sessionToWishlist(self, request, add=True):
         """Add or remove sessions from users wishlist."""
-        retval = None
-        prof = self._getProfileFromUser() # get user Profile
         # check if session exists given websafeSessionKey
-        # get conference; check that it exists
         wssk = request.websafeSessionKey
-        
-        #conf = getConferenceByKey(wsck)
-        
         try:
             session = ndb.Key(urlsafe=wssk).get()
         except:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % wssk)
-        wsck = session.key.parent().urlsafe()
-       
         if not session:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % wssk)
-            
-        # register
-        if add:
-            # check if session is already in wish list
-            if wssk in prof.sessionKeysInWishlist:
-                raise ConflictException(
-                    "You have already added this session to your wishlist")
-                
-            prof.sessionKeysInWishlist.append(wssk)
-            session.wish_list_count += 1
-            retval = True
-        # unregister
-        else:
-            if wssk in prof.sessionKeysInWishlist:
-                prof.sessionKeysInWishlist.remove(wssk)
-                session.wish_list_count -= 1
-                retval = True
-            else:
-                retval = False
-                raise ConflictException(
-                    "This session does not exist in your wishlist")
-        # write things back to the datastore & return
-        prof.put()
-        session.put()
-        
-        taskqueue.add(params={'websafeConferenceKey': wsck},
-            url='/tasks/rank_sessions')
-        return BooleanMessage(data=retval)
+        wsck = session.key.parent().urlsafe()
+        self._migrateProfile()
 
+        delta = self._toggleWishlist(session.key, add)
+        count = popularity.adjustCachedCount(session.key, delta)
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+        # update the leaderboard in place; fall back to a full re-rank if
+        # the count or the board is not cached
+        if count is None or not leaderboard.recordCount(session.key.parent(), wssk, count):
+            tasks.enqueueCoalesced('/tasks/rank_sessions', wsck)
+        return BooleanMessage(data=True)
+
+
+    @endpoints.method(CONF_LIST_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @usercontext.withUserContext
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
-        prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        fields = requestedFields(CONFERENCE_COPIER, request)
+        self._migrateProfile()
+        conf_keys = registrations.conferenceKeysAsync(
+            usercontext.current().profileKey()).get_result()
+        conferences = [conf for conf in ndb.get_multi(conf_keys) if conf]
 
         # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
         names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        if wants(fields, 'organizerDisplayName'):
+            organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
+            profiles = ndb.get_multi(organisers)
+
+            # put display names in a dict for easier fetching; imported
+            # conferences may name organizers who never signed in
+            for profile in profiles:
+                if profile:
+                    names[profile.key.id()] = profile.displayName
+
+        seatsAvailable = {}
+        if wants(fields, 'seatsAvailable'):
+            seatsAvailable = seats.getSeatsAvailableMulti(conferences)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
+        return ConferenceForms(items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId),
+            seatsAvailable.get(conf.key), fields) for conf in conferences]
         )
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @usercontext.withUserContext
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -881,10 +1360,44 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @usercontext.withUserContext
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
+
+    @endpoints.method(CONF_ATTENDEES_GET_REQUEST, AttendeeForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    @usercontext.withUserContext
+    def getConferenceAttendees(self, request):
+        """Return the attendees of a conference to its organizer."""
+        conf = self._getOwnedConference(request.websafeConferenceKey,
+                                        'list attendees of')
+        # start each Profile lookup as its registration streams in
+        profiles = []
+        def getProfile(reg_key):
+            profiles.append(reg_key.parent().get_async())
+        reg_keys, next_token = fetchPage(attendees.attendeesQuery(conf.key),
+                                         request, getProfile, keys_only=True)
+        return AttendeeForms(
+            items=[ATTENDEE_COPIER.toForm(prof) for prof in
+                   (future.get_result() for future in profiles) if prof],
+            nextPageToken=next_token)
+
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+            path='conference/{websafeConferenceKey}/attendees/export',
+            http_method='POST', name='exportConferenceAttendees')
+    @usercontext.withUserContext
+    def exportConferenceAttendees(self, request):
+        """Export the full attendee list of a conference as CSV and mail
+        its organizer a link to it."""
+        conf = self._getOwnedConference(request.websafeConferenceKey,
+                                        'export attendees of')
+        attendees.startExport(conf.key, usercontext.current().user().email())
+        return BooleanMessage(data=True)
+
   
 
 
@@ -902,10 +1415,13 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.city=="London")
         q = q.filter(Conference.topics=="Medical Innovations")
         q = q.filter(Conference.month==6)
+        confs = q.fetch()
+        seatsAvailable = seats.getSeatsAvailableMulti(confs)
 
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf, "", seatsAvailable[conf.key]) for conf in confs]
         )
 
 
-api = endpoints.api_server([ConferenceApi]) # register API
+api = instrumentation.instrumented(
+    endpoints.api_server([ConferenceApi])) # register API
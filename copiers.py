@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""copiers.py
+
+Precompiled field mappings between ndb models and ProtoRPC messages.
+The field plan of each (model, message) pair is worked out once at
+import, so copying an entity is a flat loop over (name, converter)
+pairs instead of walking all_fields() with hasattr and per-field name
+checks for every item of a list response.
+
+"""
+
+from models import AttendeeForm
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+from models import TeeShirtSize
+
+
+class FormCopier(object):
+
+    """FormCopier -- copies the properties of a model that the message
+    also has, converting values where the types differ; properties in
+    exclude are filled in by the caller"""
+
+    def __init__(self, model, message, converters=None, exclude=()):
+        converters = converters or {}
+        self.model = model
+        self.message = message
+        self.fieldNames = frozenset(field.name for field in message.all_fields())
+        self.plan = tuple((field.name, converters.get(field.name))
+                          for field in message.all_fields()
+                          if field.name in model._properties
+                          and field.name not in exclude)
+        self._partial_plans = {}
+
+    def _partialPlan(self, fields):
+        plan = self._partial_plans.get(fields)
+        if plan is None:
+            plan = tuple(step for step in self.plan if step[0] in fields)
+            self._partial_plans[fields] = plan
+        return plan
+
+    def checkFields(self, fields):
+        """Return the requested message fields as a frozenset, or None if
+        all fields are wanted; raise ValueError for unknown fields."""
+        if not fields:
+            return None
+        fields = frozenset(fields)
+        unknown = fields - self.fieldNames
+        if unknown:
+            raise ValueError('Unknown fields: %s' % ', '.join(sorted(unknown)))
+        return fields
+
+    def projection(self, fields, exclude=()):
+        """Return the model properties a projection query needs to fill the
+        given message fields, or None if they can't all be projected;
+        properties in exclude (e.g. equality filters) can't be."""
+        props = set(['name'])
+        for name, convert in self._partialPlan(fields):
+            prop = self.model._properties[name]
+            if prop._repeated or not prop._indexed or name in exclude:
+                return None
+            props.add(name)
+        return sorted(props)
+
+    def toForm(self, entity, fields=None):
+        """Return a new message filled from the entity, limited to fields
+        if given."""
+        form = self.message()
+        plan = self.plan if fields is None else self._partialPlan(fields)
+        for name, convert in plan:
+            value = getattr(entity, name)
+            if convert is not None:
+                value = convert(value)
+            setattr(form, name, value)
+        return form
+
+
+_field_names = {}
+
+
+def formToDict(form):
+    """Return {field name: value} for all fields of a message."""
+    cls = form.__class__
+    names = _field_names.get(cls)
+    if names is None:
+        names = _field_names[cls] = tuple(field.name for field in cls.all_fields())
+    return dict((name, getattr(form, name)) for name in names)
+
+
+def _teeShirtSize(value):
+    return getattr(TeeShirtSize, value)
+
+
+# dates and times go out as strings, like str() of the property value;
+# the live seat count comes from the seat shards
+CONFERENCE_COPIER = FormCopier(Conference, ConferenceForm,
+                               {'startDate': str, 'endDate': str},
+                               exclude=('seatsAvailable',))
+SESSION_COPIER = FormCopier(Session, SessionForm,
+                            {'date': str, 'start_time': str})
+# registrations and wishlist come from the Registration and
+# WishlistEntry entities
+PROFILE_COPIER = FormCopier(Profile, ProfileForm,
+                            {'teeShirtSize': _teeShirtSize},
+                            exclude=('conferenceKeysToAttend',
+                                     'sessionKeysInWishlist'))
+ATTENDEE_COPIER = FormCopier(Profile, AttendeeForm,
+                             {'teeShirtSize': _teeShirtSize})
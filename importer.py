@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""importer.py
+
+Bulk conference import used by the admin import handler. Rows are
+streamed from a JSONL or CSV upload and written in chunks: ids are
+allocated per organizer per chunk, conferences and their seat shards go
+out in one put_multi, and confirmation emails are enqueued in batches.
+
+An ImportCheckpoint records how far an import got. The keys of a chunk
+are saved before the chunk is written, so re-uploading the same file
+with the same importId skips finished rows and rewrites an interrupted
+chunk under the same keys instead of duplicating it.
+
+"""
+
+import csv
+import json
+import logging
+import re
+
+from protorpc import messages
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+from models import ImportCheckpoint
+from models import Profile
+
+import announcements
+import search
+import seats
+
+IMPORT_CHUNK = 100
+# taskqueue accepts at most 100 tasks per add() call
+TASK_BATCH = 100
+IMPORT_ID_RE = re.compile(r'^[a-zA-Z0-9_-]{1,100}$')
+
+
+def readRows(upload, file_format):
+    """Yield row dicts from an uploaded JSONL or CSV file object."""
+    if file_format == 'csv':
+        for row in csv.DictReader(upload):
+            # csv yields byte strings; protorpc wants unicode
+            try:
+                row = dict((k, v.decode('utf-8') if isinstance(v, str) else v)
+                           for k, v in row.items())
+            except UnicodeDecodeError:
+                # keep row numbers stable; reported when the row is written
+                yield {'_invalid': row, '_error': 'Row is not valid UTF-8'}
+                continue
+            # repeated fields are ';' separated in CSV
+            if row.get('topics'):
+                row['topics'] = [t.strip() for t in row['topics'].split(';') if t.strip()]
+            yield dict((k, v) for k, v in row.items() if v not in ('', None))
+    else:
+        for line in upload:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # keep row numbers stable; reported when the row is written
+                    yield {'_invalid': line}
+
+
+def _formFromRow(row):
+    if '_invalid' in row:
+        raise ValueError(row.get('_error', 'Malformed row'))
+    form = ConferenceForm()
+    for field in form.all_fields():
+        if field.name in row:
+            value = row[field.name]
+            if isinstance(field, messages.IntegerField) and isinstance(value, basestring):
+                value = int(value)
+            setattr(form, field.name, value)
+    if not form.organizerUserId:
+        raise ValueError("'organizerUserId' required")
+    return form
+
+
+def _writeChunk(checkpoint, start, rows, result):
+    """Validate and write one chunk of rows starting at row number start."""
+    forms = {}
+    for offset, row in enumerate(rows):
+        try:
+            form = _formFromRow(row)
+            forms[start + offset] = (form, ConferenceApi._conferenceDataFromForm(form))
+        except Exception as e:
+            result['errors'].append({'row': start + offset, 'error': str(e)})
+
+    # reuse the keys of an interrupted attempt at this chunk, otherwise
+    # allocate ids per organizer concurrently and save them first
+    keys = {}
+    if checkpoint.pending_row == start:
+        keys = dict(zip(checkpoint.pending_rows, checkpoint.pending_keys))
+    else:
+        by_organizer = {}
+        for row_number, (form, data) in sorted(forms.items()):
+            by_organizer.setdefault(form.organizerUserId, []).append(row_number)
+        futures = [(row_numbers, ndb.Key(Profile, user_id),
+                    Conference.allocate_ids_async(size=len(row_numbers),
+                                                  parent=ndb.Key(Profile, user_id)))
+                   for user_id, row_numbers in by_organizer.items()]
+        for row_numbers, p_key, future in futures:
+            first, last = future.get_result()
+            for i, row_number in enumerate(row_numbers):
+                keys[row_number] = ndb.Key(Conference, first + i, parent=p_key)
+        checkpoint.pending_row = start
+        checkpoint.pending_rows = sorted(keys)
+        checkpoint.pending_keys = [keys[row_number] for row_number in checkpoint.pending_rows]
+        checkpoint.put()
+
+    entities = []
+    tasks = []
+    for row_number, (form, data) in sorted(forms.items()):
+        if row_number not in keys:
+            continue
+        data['key'] = keys[row_number]
+        conf = Conference(**data)
+        entities.append(conf)
+        entities.extend(seats.newShards(conf, data['seatsAvailable']))
+        # named tasks so a resumed chunk doesn't email twice
+        tasks.append(taskqueue.Task(
+            name='import-%s-%d' % (checkpoint.key.id(), row_number),
+            url='/tasks/send_confirmation_email',
+            params={'email': form.organizerUserId, 'conferenceInfo': repr(form)}))
+    # not one transaction, as a chunk spans more than 25 entity groups;
+    # a chunk that fails is resumed with the same keys and put again
+    ndb.put_multi(entities)
+    confs = [entity for entity in entities if isinstance(entity, Conference)]
+    search.indexConferences(confs)
+    announcements.conferencesCreated(confs)
+
+    queue = taskqueue.Queue()
+    for i in range(0, len(tasks), TASK_BATCH):
+        try:
+            queue.add(tasks[i:i + TASK_BATCH])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # the rest of the batch is still added
+            pass
+
+    result['imported'] += len(tasks)
+    checkpoint.next_row = start + len(rows)
+    checkpoint.pending_row = None
+    checkpoint.pending_rows = []
+    checkpoint.pending_keys = []
+    checkpoint.put()
+
+
+def importConferences(rows, import_id):
+    """Import conferences from an iterable of row dicts, resuming the
+    import import_id where it stopped; return a summary dict."""
+    if not IMPORT_ID_RE.match(import_id or ''):
+        raise ValueError('importId must match %s' % IMPORT_ID_RE.pattern)
+    checkpoint = ImportCheckpoint.get_or_insert(import_id)
+    result = {'importId': import_id, 'imported': 0,
+              'skipped': checkpoint.next_row, 'errors': []}
+
+    chunk = []
+    start = checkpoint.next_row
+    for row_number, row in enumerate(rows):
+        if row_number < checkpoint.next_row:
+            continue
+        chunk.append(row)
+        if len(chunk) == IMPORT_CHUNK:
+            _writeChunk(checkpoint, start, chunk, result)
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        _writeChunk(checkpoint, start, chunk, result)
+
+    result['nextRow'] = checkpoint.next_row
+    logging.info('Conference import %s: %d imported, %d errors, next row %d',
+                 import_id, result['imported'], len(result['errors']),
+                 checkpoint.next_row)
+    return result
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""instrumentation.py
+
+Per-request RPC cost accounting. apiproxy hooks count and time every
+datastore, memcache, urlfetch, taskqueue, search and mail RPC made while
+a request runs in instrumented() WSGI middleware, and the finished
+request is logged as a structured cost record:
+
+    cost {"name": "ConferenceApi.getConference", "ms": 41.2,
+          "rpcs": {"datastore_v3.Get": 2, "memcache.Get": 1}, ...}
+
+Endpoints requests are named after the API method, all others after
+their path. Transaction retries show up as extra BeginTransaction and
+Rollback calls.
+
+Each instance aggregates its records and merges them into memcache
+every FLUSH_INTERVAL seconds; getStats() returns per-name call counts,
+p50/p95 latencies over the last SAMPLE_SIZE calls and RPCs per call.
+
+"""
+
+import collections
+import json
+import logging
+import re
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_STATS_KEY = 'RPC_STATS'
+# latencies kept per name for the percentiles
+SAMPLE_SIZE = 500
+FLUSH_INTERVAL = 10
+CAS_RETRIES = 5
+# services reported individually; others are summed up as 'other'
+SERVICES = ('datastore_v3', 'memcache', 'urlfetch', 'taskqueue', 'search', 'mail')
+
+_SPI_PATH_RE = re.compile(r'^/_ah/spi/(\w+\.\w+)$')
+
+_local = threading.local()
+_lock = threading.Lock()
+# name -> (latencies, calls, Counter of RPCs) not yet merged into memcache
+_pending = {}
+_last_flush = [time.time()]
+
+
+class RequestCost(object):
+
+    """RequestCost -- RPCs of one request, counted and timed per call"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.calls = collections.Counter()
+        # service -> total ms spent waiting, overlapping async RPCs included
+        self.service_ms = collections.defaultdict(float)
+        self._started = {}
+
+    def begin(self, service, call, rpc):
+        self.calls['%s.%s' % (service, call)] += 1
+        # synchronous calls come without an rpc object
+        self._started[rpc if rpc is not None else (service, call)] = time.time()
+
+    def end(self, service, call, rpc):
+        started = self._started.pop(rpc if rpc is not None else (service, call), None)
+        if started is not None:
+            service = service if service in SERVICES else 'other'
+            self.service_ms[service] += (time.time() - started) * 1000
+
+    def record(self, status):
+        return {
+            'name': self.name,
+            'status': status,
+            'ms': round((time.time() - self.start) * 1000, 1),
+            'rpcs': dict(self.calls),
+            'rpc_ms': dict((service, round(ms, 1))
+                           for service, ms in self.service_ms.items()),
+        }
+
+
+def _current():
+    return getattr(_local, 'cost', None)
+
+
+def _beforeRpc(service, call, request, response, rpc):
+    cost = _current()
+    if cost is not None:
+        cost.begin(service, call, rpc)
+
+
+def _afterRpc(service, call, request, response, rpc):
+    cost = _current()
+    if cost is not None:
+        cost.end(service, call, rpc)
+
+
+def installHooks():
+    """Install the apiproxy hooks; a no-op if they are installed already."""
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'instrumentation', _beforeRpc)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'instrumentation', _afterRpc)
+
+
+def requestName(environ):
+    """Return the name costs of a request are aggregated under."""
+    path = environ.get('PATH_INFO', '')
+    match = _SPI_PATH_RE.match(path)
+    return match.group(1) if match else path
+
+
+def _merge(stats, name, latencies, calls, rpcs):
+    entry = stats.setdefault(name, {'calls': 0, 'rpcs': {}, 'latencies': []})
+    entry['calls'] += calls
+    for call, count in rpcs.items():
+        entry['rpcs'][call] = entry['rpcs'].get(call, 0) + count
+    entry['latencies'] = (entry['latencies'] + latencies)[-SAMPLE_SIZE:]
+
+
+def flush(force=False):
+    """Merge this instance's pending records into memcache, at most every
+    FLUSH_INTERVAL seconds unless forced."""
+    with _lock:
+        if not _pending or not force and \
+                time.time() - _last_flush[0] < FLUSH_INTERVAL:
+            return
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        stats = client.gets(MEMCACHE_STATS_KEY)
+        merged = stats or {}
+        for name, (latencies, calls, rpcs) in pending.items():
+            _merge(merged, name, latencies, calls, rpcs)
+        if stats is None:
+            stored = client.add(MEMCACHE_STATS_KEY, merged)
+        else:
+            stored = client.cas(MEMCACHE_STATS_KEY, merged)
+        if stored:
+            return
+    # dropped rather than retried forever; stats are best effort
+    logging.warning('Dropped RPC stats of %d names after %d CAS attempts',
+                    len(pending), CAS_RETRIES)
+
+
+def _aggregate(record):
+    with _lock:
+        latencies, calls, rpcs = _pending.get(
+            record['name'], ([], 0, collections.Counter()))
+        rpcs.update(record['rpcs'])
+        _pending[record['name']] = ((latencies + [record['ms']])[-SAMPLE_SIZE:],
+                                    calls + 1, rpcs)
+
+
+def instrumented(app):
+    """Wrap a WSGI application so each of its requests is measured."""
+    installHooks()
+
+    def wrapper(environ, start_response):
+        cost = RequestCost(requestName(environ))
+        statuses = []
+
+        def recordingStartResponse(status, headers, exc_info=None):
+            statuses.append(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info)
+
+        _local.cost = cost
+        try:
+            return app(environ, recordingStartResponse)
+        finally:
+            _local.cost = None
+            record = cost.record(statuses[-1] if statuses else '500')
+            logging.info('cost %s', json.dumps(record, sort_keys=True))
+            _aggregate(record)
+            flush()
+    return wrapper
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def getStats():
+    """Return {name: {'calls', 'p50_ms', 'p95_ms', 'rpcs_per_call'}} of
+    all instances, as far as they have flushed."""
+    flush(force=True)
+    stats = {}
+    for name, entry in (memcache.get(MEMCACHE_STATS_KEY) or {}).items():
+        latencies = sorted(entry['latencies'])
+        calls = float(entry['calls'])
+        stats[name] = {
+            'calls': entry['calls'],
+            'p50_ms': _percentile(latencies, 0.5) if latencies else None,
+            'p95_ms': _percentile(latencies, 0.95) if latencies else None,
+            'rpcs_per_call': dict((call, round(count / calls, 2))
+                                  for call, count in entry['rpcs'].items()),
+        }
+    return stats
+
+
+def resetStats():
+    memcache.delete(MEMCACHE_STATS_KEY)
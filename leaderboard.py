@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""leaderboard.py
+
+Incrementally maintained top-K wishlist leaderboard per conference.
+The board keeps the BUFFER_FACTOR * TOP_SESSIONS best sessions as
+compact (websafeSessionKey, count) tuples plus a floor: no session
+outside the board has a count above it. Every wishlist change updates
+the memcache copy with compare-and-set, and the board lives only there:
+once evicted it is rebuilt from the live counts, since a stored copy
+would be missing every change made since it was written.
+
+The top sessions read from the board are cached in TOP_SESSIONS_CACHE,
+so a missing board is rebuilt by one request rather than by every
+viewer of the conference.
+
+"""
+
+from google.appengine.api import memcache
+
+import caching
+
+TOP_SESSIONS = 5
+BUFFER_FACTOR = 2
+MEMCACHE_LEADERBOARD_KEY = 'TOP_SESSIONS_%s'
+CAS_RETRIES = 5
+TOP_SESSIONS_CACHE = caching.TwoTierCache('TOP_SESSION_KEYS', fresh_time=600)
+
+
+def _rank(entries):
+    return sorted(entries, key=lambda entry: (-entry[1], entry[0]))
+
+
+def _trim(ranked, floor):
+    size = TOP_SESSIONS * BUFFER_FACTOR
+    if len(ranked) > size:
+        floor = max(floor, ranked[size][1])
+    return ranked[:size], floor
+
+
+def _topKeys(board, k):
+    entries, floor = board
+    # a session outside the board may tie or beat the k-th entry once
+    # that entry has dropped below the floor
+    if floor and (len(entries) < k or entries[k - 1][1] < floor):
+        return None
+    return [wssk for wssk, count in entries[:k]]
+
+
+def _cacheTopKeys(conf_key, board):
+    top = _topKeys(board, TOP_SESSIONS)
+    if top is None:
+        TOP_SESSIONS_CACHE.delete(conf_key.urlsafe())
+    else:
+        TOP_SESSIONS_CACHE.set(conf_key.urlsafe(), top)
+
+
+def storeBoard(conf_key, counts):
+    """Reset the leaderboard from {websafeSessionKey: live count} of all
+    sessions of the conference."""
+    entries, floor = _trim(_rank(counts.items()), 0)
+    memcache.set(MEMCACHE_LEADERBOARD_KEY % conf_key.urlsafe(), (entries, floor))
+    _cacheTopKeys(conf_key, (entries, floor))
+
+
+def recordCount(conf_key, wssk, count):
+    """Apply the new live count of a session to the cached leaderboard;
+    return False if there is no cached board to update."""
+    client = memcache.Client()
+    key = MEMCACHE_LEADERBOARD_KEY % conf_key.urlsafe()
+    for _ in range(CAS_RETRIES):
+        board = client.gets(key)
+        if board is None:
+            return False
+        entries, floor = board
+        counts = dict(entries)
+        # sessions outside the board only enter it once they pass the floor
+        if wssk in counts or count > floor:
+            counts[wssk] = count
+        board = _trim(_rank(counts.items()), floor)
+        if client.cas(key, board):
+            _cacheTopKeys(conf_key, board)
+            return True
+    return False
+
+
+def getTopSessionKeys(conf_key, k=TOP_SESSIONS):
+    """Return the websafe keys of the k most wishlisted sessions, or None
+    if the leaderboard is missing or can no longer tell them apart."""
+    board = memcache.get(MEMCACHE_LEADERBOARD_KEY % conf_key.urlsafe())
+    if board is None:
+        return None
+    return _topKeys(board, k)
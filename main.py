@@ -13,18 +13,40 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+import announcements
+import attendees
+import importer
+import instrumentation
+import popularity
+import registrations
+import search
+import sessionfilter
+import tasks
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
 
     def get(self):
-        """Set Announcement in Memcache."""
+        """Re-check the conferences of the announcement."""
 
-        ConferenceApi._cacheAnnouncement()
+        announcements.reconcile()
+        self.response.set_status(204)
+
+
+class RebuildAnnouncementHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Recompute the announcement from all conferences."""
+
+        announcements.rebuild()
         self.response.set_status(204)
 
 
@@ -40,6 +62,137 @@ class FeaturedSpeakersHandler(webapp2.RequestHandler):
             ConferenceApi._featuredSpeakers()
 
 
+class FoldWishlistCountsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Fold sharded wishlist deltas into Session.wish_list_count."""
+
+        popularity.foldDirty()
+        self.response.set_status(204)
+
+
+class ImportConferencesHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Bulk import Conferences from an uploaded JSONL or CSV file.
+
+        Re-posting the same file with the same importId resumes an
+        import that died partway."""
+
+        upload = self.request.POST.get('file')
+        import_id = self.request.get('importId')
+        if upload is None or not hasattr(upload, 'file'):
+            self.abort(400, detail="'file' upload required")
+        file_format = self.request.get('format') or \
+            ('csv' if upload.filename.lower().endswith('.csv') else 'jsonl')
+        try:
+            result = importer.importConferences(
+                importer.readRows(upload.file, file_format), import_id)
+        except ValueError as e:
+            self.abort(400, detail=str(e))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(result))
+
+
+class StartSearchReindexHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Start indexing all Conferences and Sessions for search."""
+
+        for kind in ('Conference', 'Session'):
+            taskqueue.add(url='/tasks/reindex_search', params={'kind': kind})
+        self.response.set_status(202)
+
+
+class ReindexSearchHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Index one batch of Conferences or Sessions and chain the next."""
+
+        cursor = self.request.get('cursor')
+        search.reindexBatch(self.request.get('kind'),
+                            Cursor(urlsafe=cursor) if cursor else None)
+
+
+class StartSessionBackfillHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Start storing the computed properties of existing Sessions."""
+
+        taskqueue.add(url='/tasks/backfill_sessions')
+        self.response.set_status(202)
+
+
+class BackfillSessionsHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Rewrite one batch of Sessions and chain the next."""
+
+        cursor = self.request.get('cursor')
+        sessionfilter.backfillBatch(Cursor(urlsafe=cursor) if cursor else None)
+
+
+class ExportAttendeesHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Write one part of an attendee list export, finish it or mail
+        its link."""
+
+        conf_key = ndb.Key(urlsafe=self.request.get('websafeConferenceKey'))
+        email = self.request.get('email')
+        export_id = self.request.get('exportId')
+        if self.request.get('mail'):
+            attendees.mailExport(conf_key, email, export_id)
+        elif self.request.get('parts'):
+            attendees.finishExport(conf_key, email, export_id,
+                                   int(self.request.get('parts')))
+        else:
+            cursor = self.request.get('cursor')
+            attendees.exportChunk(conf_key, email, export_id,
+                                  int(self.request.get('part')),
+                                  Cursor(urlsafe=cursor) if cursor else None)
+
+
+class StartProfileMigrationHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Start moving Profile registrations and wishlists into
+        Registration and WishlistEntry entities."""
+
+        taskqueue.add(url='/tasks/migrate_profiles')
+        self.response.set_status(202)
+
+
+class RpcStatsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Report calls, p50/p95 latency and RPCs per call of every
+        endpoints method and handler, and the enqueues coalesced into
+        already scheduled tasks."""
+
+        stats = instrumentation.getStats()
+        for url, count in tasks.getCoalescedCounts().items():
+            stats.setdefault(url, {})['coalesced'] = count
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats, indent=2, sort_keys=True))
+
+    def post(self):
+        """Start collecting stats afresh."""
+
+        instrumentation.resetStats()
+        tasks.resetCoalescedCounts()
+        self.response.set_status(204)
+
+
+class MigrateProfilesHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Migrate one batch of Profiles and chain the next batch."""
+
+        cursor = self.request.get('cursor')
+        registrations.migrateBatch(Cursor(urlsafe=cursor) if cursor else None)
+
+
 # TODO Add a task
 
 class RankSessionsHandler(webapp2.RequestHandler):
@@ -72,12 +225,34 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                                                               # body
 
 
-app = webapp2.WSGIApplication([('/crons/set_announcement',
+app = instrumentation.instrumented(webapp2.WSGIApplication([('/crons/set_announcement',
                               SetAnnouncementHandler),
+                              ('/crons/rebuild_announcement',
+                              RebuildAnnouncementHandler),
+                              ('/crons/fold_wishlist_counts',
+                              FoldWishlistCountsHandler),
                               ('/tasks/rank_sessions',
                               RankSessionsHandler),
                               ('/tasks/featured_speakers',
                               FeaturedSpeakersHandler),
                               ('/tasks/send_confirmation_email',
-                              SendConfirmationEmailHandler)],
-                              debug=True)
+                              SendConfirmationEmailHandler),
+                              ('/tasks/migrate_profiles',
+                              MigrateProfilesHandler),
+                              ('/tasks/export_attendees',
+                              ExportAttendeesHandler),
+                              ('/tasks/reindex_search',
+                              ReindexSearchHandler),
+                              ('/tasks/backfill_sessions',
+                              BackfillSessionsHandler),
+                              ('/admin/backfill_sessions',
+                              StartSessionBackfillHandler),
+                              ('/admin/reindex_search',
+                              StartSearchReindexHandler),
+                              ('/admin/migrate_profiles',
+                              StartProfileMigrationHandler),
+                              ('/admin/import_conferences',
+                              ImportConferencesHandler),
+                              ('/admin/rpc_stats',
+                              RpcStatsHandler)],
+                              debug=True))
@@ -33,10 +33,29 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy; moved to Registration and WishlistEntry by the migration
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionKeysInWishlist = ndb.StringProperty(repeated=True)
 
 
+class Registration(ndb.Model):
+
+    """Registration -- Profile attending a Conference; child of the
+    Profile, keyed by the websafe Conference key"""
+
+    conference = ndb.KeyProperty(kind='Conference')
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class WishlistEntry(ndb.Model):
+
+    """WishlistEntry -- Session in a Profile's wishlist; child of the
+    Profile, keyed by the websafe Session key"""
+
+    session = ndb.KeyProperty(kind='Session')
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
 class ProfileMiniForm(messages.Message):
 
     """ProfileMiniForm -- update Profile form message"""
@@ -56,6 +75,23 @@ class ProfileForm(messages.Message):
     sessionKeysInWishlist = messages.StringField(5, repeated=True)
 
 
+class AttendeeForm(messages.Message):
+
+    """AttendeeForm -- Profile registered for a Conference outbound form message"""
+
+    displayName = messages.StringField(1)
+    mainEmail = messages.StringField(2)
+    teeShirtSize = messages.EnumField('TeeShirtSize', 3)
+
+
+class AttendeeForms(messages.Message):
+
+    """AttendeeForms -- multiple AttendeeForm outbound form message"""
+
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
 class StringMessage(messages.Message):
 
     """StringMessage-- outbound (single) string message"""
@@ -70,6 +106,16 @@ class BooleanMessage(messages.Message):
     data = messages.BooleanField(1)
 
 
+class ImportCheckpoint(ndb.Model):
+
+    """ImportCheckpoint -- progress of a resumable bulk Conference import"""
+
+    next_row = ndb.IntegerProperty(default=0, indexed=False)
+    pending_row = ndb.IntegerProperty(indexed=False)
+    pending_rows = ndb.IntegerProperty(repeated=True, indexed=False)
+    pending_keys = ndb.KeyProperty(repeated=True, indexed=False)
+
+
 class Conference(ndb.Model):
 
     """Conference -- Conference object"""
@@ -83,7 +129,15 @@ class Conference(ndb.Model):
     month = ndb.IntegerProperty()  # TODO: do we need for indexing like Java?
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
-    seatsAvailable = ndb.IntegerProperty()
+    seatsAvailable = ndb.IntegerProperty()  # live count is kept in SeatShard
+    seatShards = ndb.IntegerProperty(indexed=False)
+
+
+class SeatShard(ndb.Model):
+
+    """SeatShard -- one slice of a Conference's seat inventory"""
+
+    seats = ndb.IntegerProperty(default=0, indexed=False)
 
 
 class ConferenceForm(messages.Message):
@@ -109,6 +163,7 @@ class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
 
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 
 class Session(ndb.Model):
@@ -121,6 +176,37 @@ class Session(ndb.Model):
     date = ndb.DateProperty()
     start_time = ndb.TimeProperty()
     wish_list_count = ndb.IntegerProperty()
+    # for filterSessions
+    startMinutes = ndb.ComputedProperty(
+        lambda self: self.start_time.hour * 60 + self.start_time.minute
+        if self.start_time else None)
+    typeSet = ndb.ComputedProperty(
+        lambda self: sorted(set(t.strip().lower() for t in self.typeOfSession
+                                if t.strip())), repeated=True)
+
+
+class SpeakerIndex(ndb.Model):
+
+    """SpeakerIndex -- speaker to session names of one Conference"""
+
+    speakers = ndb.JsonProperty()
+
+
+class AnnouncementSet(ndb.Model):
+
+    """AnnouncementSet -- websafe key to name of the nearly sold out
+    Conferences"""
+
+    conferences = ndb.JsonProperty(default={})
+
+
+class WishlistShard(ndb.Model):
+
+    """WishlistShard -- unfolded wishlist count delta for a Session"""
+
+    session = ndb.KeyProperty(kind='Session', indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    dirty = ndb.BooleanProperty(default=False)
 
 
 class SessionForm(messages.Message):
@@ -136,11 +222,64 @@ class SessionForm(messages.Message):
     websafeKey = messages.StringField(9)
 
 
+class SessionFilterForm(messages.Message):
+
+    """SessionFilterForm -- Session filter inbound form message"""
+
+    websafeConferenceKey = messages.StringField(1)
+    includeTypes = messages.StringField(2, repeated=True)
+    excludeTypes = messages.StringField(3, repeated=True)
+    startAfter = messages.StringField(4)  # HH:MM
+    startBefore = messages.StringField(5)  # HH:MM
+    dateFrom = messages.StringField(6)  # YYYY-MM-DD
+    dateTo = messages.StringField(7)  # YYYY-MM-DD
+    minDuration = messages.IntegerField(8)
+    maxDuration = messages.IntegerField(9)
+    speaker = messages.StringField(10)
+    pageSize = messages.IntegerField(11)
+    pageToken = messages.StringField(12)
+
+
+class SessionBatchForm(messages.Message):
+
+    """SessionBatchForm -- many Sessions of one Conference inbound form message"""
+
+    websafeConferenceKey = messages.StringField(1, required=True)
+    items = messages.MessageField(SessionForm, 2, repeated=True)
+
+
+class SessionResultForm(messages.Message):
+
+    """SessionResultForm -- outcome of one item of a SessionBatchForm"""
+
+    index = messages.IntegerField(1)
+    websafeKey = messages.StringField(2)
+    error = messages.StringField(3)
+
+
+class SessionResultForms(messages.Message):
+
+    """SessionResultForms -- multiple SessionResultForm outbound form message"""
+
+    items = messages.MessageField(SessionResultForm, 1, repeated=True)
+
+
+class SessionGroupForm(messages.Message):
+
+    """SessionGroupForm -- Sessions sharing a date or conference"""
+
+    key = messages.StringField(1)
+    name = messages.StringField(2)
+    items = messages.MessageField(SessionForm, 3, repeated=True)
+
+
 class SessionForms(messages.Message):
 
     """SessionForms -- multiple Session outbound form message"""
 
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    groups = messages.MessageField(SessionGroupForm, 3, repeated=True)
 
 
 class FeaturedSpeakerForm(messages.Message):
@@ -192,3 +331,6 @@ class ConferenceQueryForms(messages.Message):
 
     filters = messages.MessageField(ConferenceQueryForm, 1,
                                     repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True)
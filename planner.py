@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""planner.py
+
+Query planner and index advisor for queryConferences filters.
+
+A query can only run on the datastore as a whole if a composite index
+matches its exact combination of filters. The planner instead picks the
+most selective subset of the filters that one of the indexes below (or
+the built-in name index) serves, runs that, and applies the remaining
+filters in memory to the streamed results. '!=' filters are always
+applied in memory, so they never fan out into several merged queries.
+
+Every plan is logged with the index the whole query would have needed.
+adviseIndexes() turns those shapes into a minimal index.yaml; run this
+module with a log export on stdin to get one:
+
+    python planner.py < requests.log > index.yaml
+
+"""
+
+import itertools
+import re
+import sys
+
+# Conference composite indexes in index.yaml, all sorted by name
+# afterwards; keep in sync when indexes are added or removed
+CONFERENCE_INDEXES = (
+    ('city', 'maxAttendees', 'month', 'name'),
+    ('city', 'maxAttendees', 'month', 'topics', 'name'),
+    ('city', 'maxAttendees', 'name'),
+    ('city', 'month', 'name'),
+    ('city', 'month', 'topics', 'name'),
+    ('city', 'name'),
+    ('city', 'topics', 'name'),
+    ('maxAttendees', 'month', 'name'),
+    ('maxAttendees', 'month', 'topics', 'name'),
+    ('maxAttendees', 'name'),
+    ('maxAttendees', 'topics', 'name'),
+    ('month', 'name'),
+    ('month', 'topics', 'name'),
+    ('topics', 'name'),
+)
+
+# estimated fraction of conferences that pass a filter
+EQUALITY_SELECTIVITY = {'city': 0.05, 'topics': 0.1, 'month': 1 / 12.0,
+                        'maxAttendees': 0.05}
+INEQUALITY_SELECTIVITY = 0.5
+
+_COMPARE = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+_PLAN_LOG_RE = re.compile(r'Conference query plan: needs=(\S*)')
+
+
+class Plan(object):
+
+    """Plan -- filters run by the datastore and filters applied in memory"""
+
+    def __init__(self, equality, inequality_field, served, post):
+        self.equality = equality
+        self.inequality_field = inequality_field
+        self.served = served
+        self.post = post
+
+    def matches(self, entity):
+        """Whether entity passes the in-memory filters; a repeated
+        property passes if any of its values does, like in the datastore."""
+        for filtr in self.post:
+            value = getattr(entity, filtr['field'])
+            values = value if isinstance(value, list) else [value]
+            compare = _COMPARE[filtr['operator']]
+            if not any(compare(v, filtr['value']) for v in values):
+                return False
+        return True
+
+    def __str__(self):
+        return 'served=%s post=%s' % (_describe(self.served), _describe(self.post))
+
+
+def _describe(filters):
+    return ','.join('%s%s%r' % (f['field'], f['operator'], f['value'])
+                    for f in filters) or '-'
+
+
+def indexFor(equality_fields, inequality_field):
+    """Return the index properties a query with these filters needs, or
+    None if the built-in name index serves it."""
+    if not equality_fields and not inequality_field:
+        return None
+    props = sorted(equality_fields)
+    if inequality_field:
+        props.append(inequality_field)
+    return tuple(props) + ('name',)
+
+
+def _served(equality_fields, inequality_field, indexes):
+    needed = indexFor(equality_fields, inequality_field)
+    if needed is None:
+        return True
+    for index in indexes:
+        # equality properties lead the index in any order
+        split = len(equality_fields)
+        if set(index[:split]) == set(equality_fields) and \
+                index[split:] == needed[split:]:
+            return True
+    return False
+
+
+def neededShape(filters):
+    """Return (equality fields, inequality field) of the index that would
+    serve all filters but '!=' in the datastore."""
+    equality = sorted(set(f['field'] for f in filters if f['operator'] == '='))
+    ranges = [f['field'] for f in filters if f['operator'] not in ('=', '!=')]
+    return equality, ranges[0] if ranges else None
+
+
+def plan(filters, indexes=CONFERENCE_INDEXES):
+    """Return the Plan with the most selective index-served filters for
+    the given formatted filters ({'field', 'operator', 'value'})."""
+    # one equality filter per field can be served; repeated ones, like
+    # two topics, are checked in memory
+    by_field = {}
+    for filtr in filters:
+        if filtr['operator'] == '=':
+            by_field.setdefault(filtr['field'], filtr)
+    ranges = {}
+    for filtr in filters:
+        if filtr['operator'] not in ('=', '!='):
+            ranges.setdefault(filtr['field'], []).append(filtr)
+
+    best = None
+    fields = sorted(by_field)
+    for size in range(len(fields) + 1):
+        for equality in itertools.combinations(fields, size):
+            for inequality_field in [None] + sorted(ranges):
+                if inequality_field in equality:
+                    continue
+                if not _served(equality, inequality_field, indexes):
+                    continue
+                served = [by_field[field] for field in equality]
+                if inequality_field:
+                    served += ranges[inequality_field]
+                selectivity = 1.0
+                for filtr in served:
+                    selectivity *= EQUALITY_SELECTIVITY.get(filtr['field'], 1.0) \
+                        if filtr['operator'] == '=' else INEQUALITY_SELECTIVITY
+                rank = (selectivity, len(filters) - len(served))
+                if best is None or rank < best[0]:
+                    best = (rank, equality, inequality_field, served)
+
+    rank, equality, inequality_field, served = best
+    post = [filtr for filtr in filters if not any(filtr is s for s in served)]
+    return Plan(list(equality), inequality_field, served, post)
+
+
+def logLine(filters, query_plan):
+    """Return the log line recording a plan and the index its query needed."""
+    equality, inequality_field = neededShape(filters)
+    needed = indexFor(equality, inequality_field)
+    return 'Conference query plan: needs=%s %s' % (
+        ','.join(needed) if needed else '-', query_plan)
+
+
+def adviseIndexes(shapes, min_count=1):
+    """Return index.yaml text with the composite indexes needed by the
+    recorded shapes (tuples of index properties) seen at least min_count
+    times, most used first."""
+    counts = {}
+    for shape in shapes:
+        if shape:
+            counts[tuple(shape)] = counts.get(tuple(shape), 0) + 1
+    lines = ['indexes:', '']
+    for shape, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+        if count < min_count:
+            continue
+        lines.append('# used by %d logged queries' % count)
+        lines.append('- kind: Conference')
+        lines.append('  properties:')
+        lines.extend('  - name: %s' % prop for prop in shape)
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def shapesFromLog(lines):
+    """Yield the index shapes recorded in plan log lines."""
+    for line in lines:
+        match = _PLAN_LOG_RE.search(line)
+        if match and match.group(1) != '-':
+            yield tuple(match.group(1).split(','))
+
+
+if __name__ == '__main__':
+    sys.stdout.write(adviseIndexes(shapesFromLog(sys.stdin)))
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""popularity.py
+
+Sharded, write-behind wishlist counter for sessions. Wishlist adds and
+removes are recorded as deltas on one of WISHLIST_SHARDS WishlistShard
+root entities, so concurrent toggles on a popular session don't contend
+on the Session entity group. A periodic fold moves the shard deltas into
+Session.wish_list_count; the live count is always
+wish_list_count + sum(shard deltas).
+
+"""
+
+import logging
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import WishlistShard
+
+WISHLIST_SHARDS = 30
+# a fold transaction spans the Session plus this many shards; xg
+# transactions are limited to 25 entity groups
+FOLD_BATCH = 15
+MEMCACHE_WISHLIST_COUNT_KEY = 'WISHLIST_COUNT_%s'
+WISHLIST_COUNT_CACHE_TIME = 600
+
+
+def shardKeys(session_key):
+    """Return the keys of all wishlist shards of the given session."""
+    wssk = session_key.urlsafe()
+    return [ndb.Key(WishlistShard, '%s:%d' % (wssk, i))
+            for i in range(WISHLIST_SHARDS)]
+
+
+def applyDelta(session_key, delta):
+    """Add delta to a random shard of the session and return the shard
+    for the caller to put, normally in the same transaction as the
+    Profile holding the wishlist."""
+    wssk = session_key.urlsafe()
+    shard_key = ndb.Key(WishlistShard,
+                        '%s:%d' % (wssk, random.randrange(WISHLIST_SHARDS)))
+    shard = shard_key.get() or WishlistShard(key=shard_key, session=session_key)
+    shard.count += delta
+    shard.dirty = True
+    return shard
+
+
+def adjustCachedCount(session_key, delta):
+    """Apply a committed wishlist change to the memcached count, if cached;
+    return the new count or None if it was not cached."""
+    key = MEMCACHE_WISHLIST_COUNT_KEY % session_key.urlsafe()
+    if delta < 0:
+        return memcache.decr(key, -delta)
+    return memcache.incr(key, delta)
+
+
+@ndb.non_transactional
+def getWishlistCountsMulti(sessions):
+    """Return {session key: live wishlist count} for the given sessions."""
+    counts = {}
+    cache_keys = dict((MEMCACHE_WISHLIST_COUNT_KEY % session.key.urlsafe(), session)
+                      for session in sessions)
+    cached = memcache.get_multi(cache_keys.keys())
+    misses = []
+    for cache_key, session in cache_keys.items():
+        if cache_key in cached:
+            counts[session.key] = cached[cache_key]
+        else:
+            misses.append(session)
+
+    if misses:
+        keys = []
+        for session in misses:
+            keys.extend(shardKeys(session.key))
+        shards = ndb.get_multi(keys)
+        fresh = {}
+        for i, session in enumerate(misses):
+            pending = shards[i * WISHLIST_SHARDS:(i + 1) * WISHLIST_SHARDS]
+            total = (session.wish_list_count or 0) + \
+                sum(shard.count for shard in pending if shard)
+            counts[session.key] = total
+            fresh[MEMCACHE_WISHLIST_COUNT_KEY % session.key.urlsafe()] = total
+        # a count adjusted since the shards were read is newer than ours
+        memcache.add_multi(fresh, time=WISHLIST_COUNT_CACHE_TIME)
+    return counts
+
+
+@ndb.transactional(xg=True)
+def _foldShards(session_key, shard_keys):
+    session = session_key.get()
+    shards = [shard for shard in ndb.get_multi(shard_keys) if shard and shard.dirty]
+    if not session or not shards:
+        return
+    for shard in shards:
+        session.wish_list_count = (session.wish_list_count or 0) + shard.count
+        shard.count = 0
+        shard.dirty = False
+    ndb.put_multi(shards + [session])
+
+
+def foldSession(session_key):
+    """Move all pending shard deltas of a session into wish_list_count."""
+    keys = shardKeys(session_key)
+    for i in range(0, len(keys), FOLD_BATCH):
+        _foldShards(session_key, keys[i:i + FOLD_BATCH])
+
+
+def foldDirty():
+    """Fold every session that has pending wishlist deltas; used by the
+    fold cron job."""
+    session_keys = set(shard.session for shard in
+                       WishlistShard.query(WishlistShard.dirty == True))
+    for session_key in session_keys:
+        foldSession(session_key)
+    logging.info('Folded wishlist counts for %d sessions', len(session_keys))
+    return len(session_keys)
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""registrations.py
+
+Conference registrations and session wishlists as Registration and
+WishlistEntry child entities of the Profile, keyed by the websafe key
+of the Conference or Session. Membership is a get by key, registering
+doesn't rewrite the Profile, and the attendees of a conference are an
+indexed query on Registration.conference.
+
+Profiles written before the join entities existed keep their keys in
+the repeated Profile properties until migrateProfile moves them; the
+migration runs as a chain of tasks over all Profiles and, for a user
+who comes by first, on their next registration or wishlist request.
+
+"""
+
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import Registration
+from models import WishlistEntry
+
+MIGRATION_BATCH = 100
+
+
+def registrationKey(p_key, wsck):
+    return ndb.Key(Registration, wsck, parent=p_key)
+
+
+def wishlistKey(p_key, wssk):
+    return ndb.Key(WishlistEntry, wssk, parent=p_key)
+
+
+def newRegistration(p_key, conf_key):
+    """Return a Registration of the profile for the conference; caller puts."""
+    return Registration(key=registrationKey(p_key, conf_key.urlsafe()),
+                        conference=conf_key)
+
+
+def newWishlistEntry(p_key, session_key):
+    """Return a WishlistEntry of the profile for the session; caller puts."""
+    return WishlistEntry(key=wishlistKey(p_key, session_key.urlsafe()),
+                         session=session_key)
+
+
+def conferenceKeysAsync(p_key):
+    """Return a future for the keys of the conferences the profile
+    attends, in the order of their websafe keys."""
+    return Registration.query(ancestor=p_key).map_async(
+        lambda key: ndb.Key(urlsafe=key.id()), keys_only=True)
+
+
+def sessionKeysAsync(p_key):
+    """Return a future for the keys of the sessions in the profile's
+    wishlist, in the order of their websafe keys."""
+    return WishlistEntry.query(ancestor=p_key).map_async(
+        lambda key: ndb.Key(urlsafe=key.id()), keys_only=True)
+
+
+def hasLegacy(prof):
+    """Whether the profile still has keys in its repeated properties."""
+    return bool(prof.conferenceKeysToAttend or prof.sessionKeysInWishlist)
+
+
+def migrate(prof):
+    """Move the keys of the repeated Profile properties into join
+    entities; return them for the caller to put together with prof."""
+    entities = []
+    for name, new in (('conferenceKeysToAttend', newRegistration),
+                      ('sessionKeysInWishlist', newWishlistEntry)):
+        for websafe_key in getattr(prof, name):
+            try:
+                key = ndb.Key(urlsafe=websafe_key)
+            except Exception:
+                logging.warning('Dropping malformed key %s of %s',
+                                websafe_key, prof.key)
+                continue
+            entities.append(new(prof.key, key))
+        setattr(prof, name, [])
+    return entities
+
+
+@ndb.transactional
+def migrateProfile(p_key):
+    """Migrate one profile; a no-op if it was migrated already."""
+    prof = p_key.get()
+    if prof and hasLegacy(prof):
+        ndb.put_multi(migrate(prof) + [prof])
+
+
+def migrateBatch(cursor=None):
+    """Migrate the next MIGRATION_BATCH profiles after cursor and chain a
+    task for the rest; return the number of profiles migrated."""
+    profs, next_cursor, more = Profile.query().fetch_page(
+        MIGRATION_BATCH, start_cursor=cursor)
+    migrated = 0
+    for prof in profs:
+        if hasLegacy(prof):
+            migrateProfile(prof.key)
+            migrated += 1
+    if more and next_cursor:
+        taskqueue.add(url='/tasks/migrate_profiles',
+                      params={'cursor': next_cursor.urlsafe()})
+    else:
+        logging.info('Profile migration finished')
+    return migrated
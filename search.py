@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""search.py
+
+Full-text search over conferences and sessions. Text fields are split
+into lowercase word tokens, and every prefix of every token is indexed,
+so a query matches words that start with its terms. A term counts once
+for each time its field weight says, which ranks name matches above
+description matches. All query terms must match.
+
+Two backends with the same interface: the App Engine Search API in
+production, and an in-process inverted index on the development server
+and in tests; setBackend() swaps in another.
+
+"""
+
+import collections
+import logging
+import os
+import re
+import threading
+
+from google.appengine.api import search as gae_search
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+CONFERENCE_INDEX = 'conferences'
+SESSION_INDEX = 'sessions'
+# how often a field's terms count towards the score of a match
+CONFERENCE_WEIGHTS = {'name': 3, 'topics': 2, 'city': 1, 'description': 1}
+SESSION_WEIGHTS = {'name': 3, 'speaker': 2, 'typeOfSession': 1, 'highlights': 1}
+# longer words are indexed by their first MAX_PREFIX characters
+MAX_PREFIX = 20
+# the Search API accepts at most 200 documents per put
+PUT_BATCH = 200
+REINDEX_BATCH = 200
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the lowercase word tokens of text."""
+    return [token.lower() for token in _TOKEN_RE.findall(text or '')]
+
+
+def documentTerms(fields, weights):
+    """Return the index terms of a document given as {field: text}, each
+    prefix of each token repeated by the weight of its field."""
+    terms = []
+    for name, text in fields.items():
+        for token in tokenize(text):
+            prefixes = [token[:i] for i in range(1, min(len(token), MAX_PREFIX) + 1)]
+            terms.extend(prefixes * weights.get(name, 1))
+    return terms
+
+
+class LocalSearchBackend(object):
+
+    """LocalSearchBackend -- in-process inverted index for development
+    and tests; not shared between instances"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # index name -> term -> {doc_id: term frequency}
+        self._postings = collections.defaultdict(
+            lambda: collections.defaultdict(dict))
+        # index name -> doc_id -> terms, to unindex on update
+        self._docs = collections.defaultdict(dict)
+
+    def index(self, index_name, docs):
+        """Add or replace documents given as (doc_id, terms) pairs."""
+        with self._lock:
+            postings = self._postings[index_name]
+            for doc_id, terms in docs:
+                for term in self._docs[index_name].pop(doc_id, ()):
+                    postings[term].pop(doc_id, None)
+                counts = collections.Counter(terms)
+                for term, count in counts.items():
+                    postings[term][doc_id] = count
+                self._docs[index_name][doc_id] = counts.keys()
+
+    def search(self, index_name, terms, limit, cursor=None):
+        """Return (doc_ids, next_cursor) of the best documents matching
+        all terms, starting at cursor."""
+        try:
+            offset = int(cursor or 0)
+        except ValueError:
+            raise ValueError('Invalid cursor: %s' % cursor)
+        with self._lock:
+            postings = self._postings[index_name]
+            scores = None
+            for term in set(terms):
+                matches = postings.get(term, {})
+                if scores is None:
+                    scores = dict(matches)
+                else:
+                    scores = dict((doc_id, score + matches[doc_id])
+                                  for doc_id, score in scores.items()
+                                  if doc_id in matches)
+        ranked = sorted((scores or {}).items(),
+                        key=lambda item: (-item[1], item[0]))
+        page = [doc_id for doc_id, score in ranked[offset:offset + limit]]
+        next_cursor = str(offset + limit) if len(ranked) > offset + limit else None
+        return page, next_cursor
+
+
+class AppEngineSearchBackend(object):
+
+    """AppEngineSearchBackend -- documents in the App Engine Search API,
+    scored by term frequency"""
+
+    def index(self, index_name, docs):
+        """Add or replace documents given as (doc_id, terms) pairs."""
+        documents = [gae_search.Document(doc_id=doc_id, fields=[
+                         gae_search.TextField(name='terms', value=' '.join(terms))])
+                     for doc_id, terms in docs]
+        index = gae_search.Index(name=index_name)
+        for i in range(0, len(documents), PUT_BATCH):
+            index.put(documents[i:i + PUT_BATCH])
+
+    def search(self, index_name, terms, limit, cursor=None):
+        """Return (doc_ids, next_cursor) of the best documents matching
+        all terms, starting at cursor."""
+        try:
+            cursor = gae_search.Cursor(web_safe_string=cursor) if cursor \
+                else gae_search.Cursor()
+        except Exception:
+            raise ValueError('Invalid cursor: %s' % cursor)
+        options = gae_search.QueryOptions(
+            limit=limit, cursor=cursor, ids_only=True,
+            sort_options=gae_search.SortOptions(
+                match_scorer=gae_search.MatchScorer(),
+                expressions=[gae_search.SortExpression(
+                    expression='_score',
+                    direction=gae_search.SortExpression.DESCENDING,
+                    default_value=0)]))
+        query_string = ' '.join('terms:"%s"' % term for term in terms)
+        results = gae_search.Index(name=index_name).search(
+            gae_search.Query(query_string=query_string, options=options))
+        next_cursor = results.cursor.web_safe_string if results.cursor else None
+        return [doc.doc_id for doc in results], next_cursor
+
+
+_backend = None
+
+
+def getBackend():
+    """Return the search backend of this instance."""
+    global _backend
+    if _backend is None:
+        if os.environ.get('SERVER_SOFTWARE', 'Development').startswith('Development'):
+            _backend = LocalSearchBackend()
+        else:
+            _backend = AppEngineSearchBackend()
+    return _backend
+
+
+def setBackend(backend):
+    global _backend
+    _backend = backend
+
+
+def _conferenceFields(conf):
+    return {'name': conf.name, 'description': conf.description,
+            'city': conf.city, 'topics': ' '.join(conf.topics)}
+
+
+def _sessionFields(session):
+    return {'name': session.name, 'speaker': session.speaker,
+            'highlights': session.highlights,
+            'typeOfSession': ' '.join(session.typeOfSession)}
+
+
+def _index(index_name, entities, fields, weights):
+    docs = [(entity.key.urlsafe(), documentTerms(fields(entity), weights))
+            for entity in entities]
+    # documents only ever describe committed entities
+    ndb.get_context().call_on_commit(
+        lambda: getBackend().index(index_name, docs))
+
+
+def indexConferences(confs):
+    """(Re)index the conferences, once the current transaction commits."""
+    _index(CONFERENCE_INDEX, confs, _conferenceFields, CONFERENCE_WEIGHTS)
+
+
+def indexSessions(sessions):
+    """(Re)index the sessions, once the current transaction commits."""
+    _index(SESSION_INDEX, sessions, _sessionFields, SESSION_WEIGHTS)
+
+
+_REINDEXERS = {'Conference': indexConferences, 'Session': indexSessions}
+
+
+def reindexBatch(kind, cursor=None):
+    """Index the next REINDEX_BATCH entities of kind ('Conference' or
+    'Session') after cursor and chain a task for the rest; used to index
+    entities written before search existed."""
+    query = ndb.Query(kind=kind)
+    entities, next_cursor, more = query.fetch_page(REINDEX_BATCH,
+                                                   start_cursor=cursor)
+    _REINDEXERS[kind](entities)
+    if more and next_cursor:
+        taskqueue.add(url='/tasks/reindex_search',
+                      params={'kind': kind, 'cursor': next_cursor.urlsafe()})
+    else:
+        logging.info('Search reindex of %s finished', kind)
+
+
+def _search(index_name, text, limit, cursor):
+    terms = [token[:MAX_PREFIX] for token in tokenize(text)]
+    doc_ids, next_cursor = getBackend().search(index_name, terms, limit, cursor)
+    return [ndb.Key(urlsafe=doc_id) for doc_id in doc_ids], next_cursor
+
+
+def searchConferences(text, limit, cursor=None):
+    """Return (conference keys, next cursor) of the best matches for text;
+    raise ValueError for an invalid cursor."""
+    return _search(CONFERENCE_INDEX, text, limit, cursor)
+
+
+def searchSessions(text, limit, cursor=None):
+    """Return (session keys, next cursor) of the best matches for text;
+    raise ValueError for an invalid cursor."""
+    return _search(SESSION_INDEX, text, limit, cursor)
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""seats.py
+
+Sharded seat inventory for conferences. The seats of a conference are
+split across SeatShard root entities so that concurrent registrations
+write to different entity groups instead of all contending on the
+Conference entity. Each shard owns its own slice of seats and is only
+decremented transactionally while it has seats left, so the sum over
+the shards can never go below zero.
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+# a new Conference is put in one xg transaction with its shards (see
+# createWithShards), and xg transactions are limited to 25 entity groups
+MAX_SEAT_SHARDS = 20
+MEMCACHE_SEATS_KEY = 'SEATS_AVAILABLE_%s'
+SEATS_CACHE_TIME = 60
+
+
+def shardKeys(conf):
+    """Return the keys of all seat shards of the given conference."""
+    wsck = conf.key.urlsafe()
+    return [ndb.Key(SeatShard, '%s:%d' % (wsck, i))
+            for i in range(conf.seatShards or 0)]
+
+
+def newShards(conf, seats):
+    """Split seats over fresh shards for conf; caller puts the result."""
+    seats = max(seats or 0, 0)
+    num = max(1, min(MAX_SEAT_SHARDS, seats))
+    conf.seatShards = num
+    return [SeatShard(key=key, seats=seats // num + (1 if i < seats % num else 0))
+            for i, key in enumerate(shardKeys(conf))]
+
+
+@ndb.transactional(xg=True)
+def createWithShards(conf, seats):
+    """Put the new conf together with its shards, so no Conference is
+    ever stored without them."""
+    ndb.put_multi([conf] + newShards(conf, seats))
+
+
+@ndb.transactional(xg=True)
+def _initShards(conf_key):
+    conf = conf_key.get()
+    if conf.seatShards is None:
+        shards = newShards(conf, conf.seatsAvailable)
+        ndb.put_multi(shards + [conf])
+    return conf
+
+
+def ensureShards(conf):
+    """Return conf, splitting the legacy seatsAvailable count into shards
+    for conferences created before seat sharding."""
+    if conf.seatShards is None:
+        conf = _initShards(conf.key)
+    return conf
+
+
+def resizeShards(conf, delta):
+    """Add delta seats to the shards of conf, or take -delta free seats
+    away; return the changed shards for the caller to put in the same
+    transaction, or None if fewer than -delta seats are free."""
+    shards = [shard for shard in ndb.get_multi(shardKeys(conf)) if shard]
+    if delta >= 0:
+        for i, shard in enumerate(shards):
+            shard.seats += delta // len(shards) + (1 if i < delta % len(shards) else 0)
+        return shards
+    needed = -delta
+    changed = []
+    for shard in sorted(shards, key=lambda shard: -shard.seats):
+        if not needed:
+            break
+        taken = min(shard.seats, needed)
+        if taken:
+            shard.seats -= taken
+            needed -= taken
+            changed.append(shard)
+    return None if needed else changed
+
+
+def shardsToTry(conf):
+    """Yield shard keys to take a seat from: one random shard first and,
+    should that turn out empty, the remaining shards with seats left."""
+    keys = shardKeys(conf)
+    first = random.choice(keys)
+    yield first
+    remaining = [shard.key for shard in ndb.get_multi(keys)
+                 if shard and shard.seats > 0 and shard.key != first]
+    random.shuffle(remaining)
+    for key in remaining:
+        yield key
+
+
+def randomShard(conf):
+    """Return the key of a random shard, e.g. to give a seat back to."""
+    return random.choice(shardKeys(conf))
+
+
+def adjustCachedSeats(conf, delta):
+    """Apply a committed seat change to the memcached total, if cached;
+    return the new total, or None if it wasn't cached."""
+    key = MEMCACHE_SEATS_KEY % conf.key.urlsafe()
+    if delta < 0:
+        return memcache.decr(key, -delta)
+    return memcache.incr(key, delta)
+
+
+@ndb.non_transactional
+def getSeatsAvailableMulti(confs):
+    """Return {conference key: seats available} for the given conferences,
+    aggregated over their shards and cached in memcache."""
+    seats = {}
+    cache_keys = dict((MEMCACHE_SEATS_KEY % conf.key.urlsafe(), conf)
+                      for conf in confs)
+    cached = memcache.get_multi(cache_keys.keys())
+    misses = []
+    for cache_key, conf in cache_keys.items():
+        if cache_key in cached:
+            seats[conf.key] = cached[cache_key]
+        else:
+            misses.append(conf)
+
+    # results of projection queries lack the shard count
+    projected = [conf.key for conf in misses if conf._projection]
+    if projected:
+        full = dict((conf.key, conf) for conf in ndb.get_multi(projected) if conf)
+        misses = [full.get(conf.key, conf) if conf._projection else conf
+                  for conf in misses]
+        for conf in misses:
+            if conf._projection:
+                # deleted since it was queried
+                seats[conf.key] = 0
+        misses = [conf for conf in misses if not conf._projection]
+
+    # conferences from before seat sharding aren't cached
+    for conf in misses:
+        if conf.seatShards is None:
+            seats[conf.key] = conf.seatsAvailable or 0
+    misses = [conf for conf in misses if conf.seatShards is not None]
+
+    if misses:
+        keys = []
+        for conf in misses:
+            keys.extend(shardKeys(conf))
+        shards = ndb.get_multi(keys)
+        fresh = {}
+        pos = 0
+        for conf in misses:
+            total = sum(shard.seats for shard in
+                        shards[pos:pos + conf.seatShards] if shard)
+            pos += conf.seatShards
+            seats[conf.key] = total
+            fresh[MEMCACHE_SEATS_KEY % conf.key.urlsafe()] = total
+        # add, so a total decremented by a registration since the shards
+        # were read is not overwritten with the stale one
+        memcache.add_multi(fresh, time=SEATS_CACHE_TIME)
+    return seats
+
+
+def getSeatsAvailable(conf):
+    """Return the number of seats available for a single conference."""
+    return getSeatsAvailableMulti([conf])[conf.key]
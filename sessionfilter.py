@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""sessionfilter.py
+
+Executor for filterSessions. Of the constraints of a SessionFilterForm
+the most selective one that an index serves runs in the datastore,
+within the conference if one is given; the rest are checked in memory
+as the results stream in. Reads are therefore proportional to the
+matches of that one constraint rather than to the size of the
+conference, and no constraint turns into several merged sub-queries.
+
+Start times and session types are matched on the computed
+Session.startMinutes and Session.typeSet properties.
+
+"""
+
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Session
+
+BACKFILL_BATCH = 100
+
+# constraints the datastore can run, most selective first; the index
+# backing each is in index.yaml (ancestor) or built in (no ancestor)
+SERVABLE = ('speaker', 'typeSet', 'startMinutes', 'date', 'duration')
+
+
+def normalizeType(name):
+    return (name or '').strip().lower()
+
+
+def _parse(value, fmt, what):
+    try:
+        return datetime.strptime(value, fmt)
+    except (TypeError, ValueError):
+        raise ValueError('%s must be formatted as %s' % (what, fmt))
+
+
+class SessionFilter(object):
+
+    """SessionFilter -- parsed constraints of a SessionFilterForm"""
+
+    def __init__(self, form):
+        self.speaker = form.speaker
+        self.includeTypes = set(normalizeType(t) for t in form.includeTypes) - set([''])
+        self.excludeTypes = set(normalizeType(t) for t in form.excludeTypes) - set([''])
+        # ranges are (lowest, highest) with None for open ends
+        self.ranges = {}
+        start = [None, None]
+        for i, value in enumerate((form.startAfter, form.startBefore)):
+            if value:
+                t = _parse(value, '%H:%M', 'Start times')
+                start[i] = t.hour * 60 + t.minute
+        dates = [None, None]
+        for i, value in enumerate((form.dateFrom, form.dateTo)):
+            if value:
+                dates[i] = _parse(value, '%Y-%m-%d', 'Dates').date()
+        for name, bounds in (('startMinutes', start), ('date', dates),
+                             ('duration', [form.minDuration, form.maxDuration])):
+            if bounds != [None, None]:
+                self.ranges[name] = tuple(bounds)
+
+    def _served(self):
+        """Return the constraint the datastore should run: the most
+        selective one that a single property index can serve."""
+        candidates = set(self.ranges)
+        if self.speaker:
+            candidates.add('speaker')
+        # several included types would need an OR of queries
+        if len(self.includeTypes) == 1:
+            candidates.add('typeSet')
+        for name in SERVABLE:
+            if name in candidates:
+                return name
+        return None
+
+    def query(self, conf_key=None):
+        """Return the datastore query for the served constraint."""
+        q = Session.query(ancestor=conf_key) if conf_key else Session.query()
+        served = self._served()
+        if served == 'speaker':
+            q = q.filter(Session.speaker == self.speaker)
+        elif served == 'typeSet':
+            q = q.filter(Session.typeSet == list(self.includeTypes)[0])
+        elif served:
+            prop = Session._properties[served]
+            low, high = self.ranges[served]
+            if low is not None:
+                q = q.filter(prop >= low)
+            if high is not None:
+                q = q.filter(prop <= high)
+            q = q.order(prop)
+        return q.order(Session.key)
+
+    def matches(self, session):
+        """Whether the session passes all constraints; sessions without a
+        value for a constrained property never do."""
+        if self.speaker and session.speaker != self.speaker:
+            return False
+        types = set(session.typeSet)
+        if self.includeTypes and not (types & self.includeTypes):
+            return False
+        if types & self.excludeTypes:
+            return False
+        for name, (low, high) in self.ranges.items():
+            value = getattr(session, name)
+            if value is None or \
+                    (low is not None and value < low) or \
+                    (high is not None and value > high):
+                return False
+        return True
+
+
+def backfillBatch(cursor=None):
+    """Rewrite the next BACKFILL_BATCH sessions after cursor, storing
+    their computed properties, and chain a task for the rest."""
+    sessions, next_cursor, more = Session.query().fetch_page(
+        BACKFILL_BATCH, start_cursor=cursor)
+    ndb.put_multi(sessions)
+    if more and next_cursor:
+        taskqueue.add(url='/tasks/backfill_sessions',
+                      params={'cursor': next_cursor.urlsafe()})
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""speakers.py
+
+Per-conference speaker index. A SpeakerIndex child entity of each
+Conference maps speakers to the names of their sessions; it is updated
+in the same transaction that creates a session and mirrored to
+FEATURED_SPEAKERS_CACHE, so featured speakers are answered without
+scanning the sessions.
+
+"""
+
+from google.appengine.ext import ndb
+
+import caching
+from models import Session
+from models import SpeakerIndex
+
+FEATURED_SPEAKERS_CACHE = caching.TwoTierCache('FEATURED_SPEAKERS', fresh_time=600)
+# speakers with at least this many sessions are featured
+FEATURED_MIN_SESSIONS = 2
+
+
+def indexKey(conf_key):
+    """Return the key of the speaker index of a conference."""
+    return ndb.Key(SpeakerIndex, 'speakers', parent=conf_key)
+
+
+def featuredSpeakers(index):
+    """Return {speaker: [session names]} for the featured speakers."""
+    return dict((speaker, names) for speaker, names in index.speakers.items()
+                if len(names) >= FEATURED_MIN_SESSIONS)
+
+
+def sessionNames(index):
+    """Return the names of all sessions recorded in the index."""
+    return set(name for names in index.speakers.values() for name in names)
+
+
+def _mirror(index):
+    FEATURED_SPEAKERS_CACHE.set(index.key.parent().urlsafe(),
+                                featuredSpeakers(index))
+
+
+def addSessions(conf_key, sessions):
+    """Record new sessions in the conference's speaker index and return
+    the index for the caller to put in the transaction creating the
+    sessions; the cache is updated once that transaction commits."""
+    index = indexKey(conf_key).get() or \
+        SpeakerIndex(key=indexKey(conf_key), speakers={})
+    for session in sessions:
+        index.speakers.setdefault(session.speaker, []).append(session.name)
+    ndb.get_context().call_on_commit(lambda: _mirror(index))
+    return index
+
+
+def rebuildIndex(conf_key):
+    """Rebuild the speaker index of a conference from its sessions."""
+    index = SpeakerIndex(key=indexKey(conf_key), speakers={})
+    for session in Session.query(ancestor=conf_key):
+        index.speakers.setdefault(session.speaker, []).append(session.name)
+    index.put()
+    _mirror(index)
+    return index
+
+
+def _loadFeaturedSpeakers(conf_key):
+    index = indexKey(conf_key).get()
+    if not index:
+        # conferences created before the index existed get it built once
+        if not conf_key.get():
+            return None
+        index = rebuildIndex(conf_key)
+    return featuredSpeakers(index)
+
+
+def getFeaturedSpeakers(conf_key):
+    """Return the featured speakers of a conference, or None if there is
+    no such conference."""
+    return FEATURED_SPEAKERS_CACHE.get(conf_key.urlsafe(),
+                                       lambda: _loadFeaturedSpeakers(conf_key))
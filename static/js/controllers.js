@@ -293,6 +293,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Holds the token of the next page of conferences on the server, if any.
+     * @type {string}
+     */
+    $scope.nextPageToken = null;
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -379,6 +385,27 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         return angular.element(event.target).hasClass('disabled');
     }
 
+    /**
+     * Checks if there is a page after the current one, either already loaded or on the server.
+     *
+     * @returns {boolean}
+     */
+    $scope.pagination.hasNextPage = function () {
+        return $scope.pagination.currentPage < $scope.pagination.numberOfPages() - 1 ||
+            !!$scope.nextPageToken;
+    };
+
+    /**
+     * Moves to the next page, fetching it from the server if it has not been loaded yet.
+     */
+    $scope.pagination.nextPage = function () {
+        if ($scope.pagination.currentPage < $scope.pagination.numberOfPages() - 1) {
+            $scope.pagination.currentPage++;
+        } else if ($scope.nextPageToken) {
+            $scope.queryConferencesAll($scope.nextPageToken);
+        }
+    };
+
     /**
      * Adds a filter and set the default value.
      */
@@ -414,6 +441,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.queryConferences = function () {
         $scope.submitted = false;
+        $scope.nextPageToken = null;
+        $scope.pagination.currentPage = 0;
         if ($scope.selectedTab == 'ALL') {
             $scope.queryConferencesAll();
         } else if ($scope.selectedTab == 'YOU_HAVE_CREATED') {
@@ -425,10 +454,19 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 
     /**
      * Invokes the conference.queryConferences API.
+     *
+     * @param pageToken the token of the page to fetch and append; the first page is fetched if omitted.
      */
-    $scope.queryConferencesAll = function () {
+    $scope.queryConferencesAll = function (pageToken) {
         var sendFilters = {
-            filters: []
+            filters: [],
+            pageSize: $scope.pagination.pageSize,
+            // only what the list shows; the server can then use a projection query
+            fields: ['name', 'city', 'startDate', 'maxAttendees', 'seatsAvailable',
+                'organizerDisplayName', 'websafeKey']
+        }
+        if (pageToken) {
+            sendFilters.pageToken = pageToken;
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -458,10 +496,15 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
+                        if (pageToken) {
+                            $scope.pagination.currentPage = $scope.pagination.numberOfPages();
+                        } else {
+                            $scope.conferences = [];
+                        }
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.nextPageToken = resp.nextPageToken || null;
                     }
                     $scope.submitted = true;
                 });
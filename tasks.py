@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""tasks.py
+
+Coalescing scheduler for per-conference background jobs. Enqueues for
+the same job and conference within one time window map to a single
+named task that runs at the end of the window, so a burst of requests
+costs at most one recompute per conference per window. Enqueues that
+were folded into an existing task are counted in memcache and reported
+by /admin/rpc_stats.
+
+"""
+
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+TASK_COALESCE_WINDOW = 30  # seconds
+MEMCACHE_COALESCED_KEY = 'COALESCED_TASKS_%s'
+# task urls scheduled through enqueueCoalesced, for reporting
+COALESCED_URLS = ('/tasks/rank_sessions',)
+
+
+def enqueueCoalesced(url, websafeConferenceKey, window=TASK_COALESCE_WINDOW):
+    """Schedule the task at url for the conference unless one is already
+    scheduled for the current window; return True if a task was added."""
+    now = time.time()
+    bucket = int(now // window)
+    # websafe keys only use characters allowed in task names
+    name = '%s-%s-%d-%d' % (url.strip('/').replace('/', '-'),
+                            websafeConferenceKey, window, bucket)
+    try:
+        taskqueue.add(name=name, url=url,
+                      params={'websafeConferenceKey': websafeConferenceKey},
+                      countdown=max(0, (bucket + 1) * window - now))
+        return True
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        memcache.incr(MEMCACHE_COALESCED_KEY % url, initial_value=0)
+        logging.debug('Coalesced %s for %s', url, websafeConferenceKey)
+        return False
+
+
+def getCoalescedCounts(urls=COALESCED_URLS):
+    """Return {url: how many enqueues for it were coalesced so far}."""
+    cached = memcache.get_multi([MEMCACHE_COALESCED_KEY % url for url in urls])
+    return dict((url, cached.get(MEMCACHE_COALESCED_KEY % url, 0)) for url in urls)
+
+
+def resetCoalescedCounts(urls=COALESCED_URLS):
+    memcache.delete_multi([MEMCACHE_COALESCED_KEY % url for url in urls])
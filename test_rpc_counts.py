@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_rpc_counts.py
+
+RPC-count tests of ConferenceApi methods on the testbed stubs, using
+the seeding and RpcCounter of benchmark_api.py. Needs the App Engine
+SDK on sys.path.
+
+usage: python -m unittest test_rpc_counts
+
+"""
+
+import argparse
+import os
+import random
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import benchmark_api
+import conference
+from conference import ConferenceApi
+from models import ConferenceQueryForms
+from models import Profile
+from models import ProfileMiniForm
+from models import TeeShirtSize
+
+
+class RpcCountTestCase(unittest.TestCase):
+
+    """RpcCountTestCase -- seeded testbed with an RpcCounter installed"""
+
+    SEED = dict(conferences=45, sessions=3, profiles=5, organizers=2,
+                registrations=1, wishlist=1, seats=100)
+
+    def setUp(self):
+        self.bed = benchmark_api.setUp()
+        self.data = benchmark_api.seed(argparse.Namespace(**self.SEED),
+                                       random.Random(0))
+        self.counter = benchmark_api.RpcCounter()
+        self.counter.install()
+        self.api = ConferenceApi()
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def call(self, method, request, email=None):
+        """Call the method as a fresh request of email; return its result
+        with the RPCs it made in self.counter."""
+        os.environ[benchmark_api.AUTH_EMAIL] = email or ''
+        os.environ[benchmark_api.AUTH_DOMAIN] = 'example.com'
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+        self.counter.reset()
+        return method(request)
+
+
+class QueryPassTest(RpcCountTestCase):
+
+    def testOneQueryPassPerPage(self):
+        page_size = 20
+        seen = []
+        token = None
+        for page in range(3):
+            result = self.call(self.api.queryConferences,
+                               ConferenceQueryForms(pageSize=page_size,
+                                                    pageToken=token))
+            calls = self.counter.calls
+            # one query, plus at most one batch for the lookahead result
+            self.assertEqual(calls['datastore_v3.RunQuery'], 1)
+            self.assertLessEqual(calls['datastore_v3.Next'], 1)
+            seen.extend(item.websafeKey for item in result.items)
+            token = result.nextPageToken
+        self.assertEqual(len(seen), self.SEED['conferences'])
+        self.assertEqual(len(set(seen)), len(seen))
+        self.assertFalse(token)
+
+
+class UserContextTest(RpcCountTestCase):
+
+    EMAIL = 'tester@example.com'
+
+    def setUp(self):
+        super(UserContextTest, self).setUp()
+        Profile(key=ndb.Key(Profile, self.EMAIL), displayName='Tester',
+                mainEmail=self.EMAIL).put()
+        self.profile_gets = 0
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'profile_gets', self._countProfileGets, 'datastore_v3')
+
+    def _countProfileGets(self, service, call, request, response):
+        if call == 'Get':
+            self.profile_gets += sum(
+                1 for key in request.key_list()
+                if key.path().element_list()[-1].type() == 'Profile')
+
+    def assertResolvedOnce(self):
+        self.assertEqual(self.profile_gets, 1)
+        self.assertEqual(sum(count for call, count in self.counter.calls.items()
+                             if call.startswith('urlfetch.')), 0)
+
+    def testUpdateConferenceResolvesProfileOnce(self):
+        conf = self.data['conferences'][0]
+        self.profile_gets = 0
+        form = self.call(self.api.updateConference,
+                         conference.CONF_POST_REQUEST.combined_message_class(
+                             websafeConferenceKey=conf.key.urlsafe(),
+                             name='Renamed'),
+                         conf.organizerUserId)
+        self.assertEqual(form.name, 'Renamed')
+        self.assertResolvedOnce()
+
+    def testRegistrationResolvesProfileOnce(self):
+        conf = self.data['conferences'][0]
+        self.profile_gets = 0
+        result = self.call(self.api.registerForConference,
+                           conference.CONF_GET_REQUEST.combined_message_class(
+                               websafeConferenceKey=conf.key.urlsafe()),
+                           self.EMAIL)
+        self.assertTrue(result.data)
+        self.assertResolvedOnce()
+
+
+class WriteCoalescingTest(RpcCountTestCase):
+
+    EMAIL = 'writer@example.com'
+
+    def setUp(self):
+        super(WriteCoalescingTest, self).setUp()
+        Profile(key=ndb.Key(Profile, self.EMAIL), displayName='Writer',
+                mainEmail=self.EMAIL).put()
+        self.conf = self.data['conferences'][0]
+        self.session = self.data['sessions'][self.conf.key][0]
+
+    def assertWrites(self, puts, deletes):
+        self.assertEqual(self.counter.calls['datastore_v3.Put'], puts)
+        self.assertEqual(self.counter.calls['datastore_v3.Delete'], deletes)
+
+    def register(self, method):
+        return self.call(method, conference.CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=self.conf.key.urlsafe()), self.EMAIL)
+
+    def wishlist(self, method):
+        return self.call(method, conference.SESSION_GET_REQUEST.combined_message_class(
+            websafeSessionKey=self.session.key.urlsafe()), self.EMAIL)
+
+    def testRegisterWritesOnce(self):
+        self.assertTrue(self.register(self.api.registerForConference).data)
+        # Registration and seat shard
+        self.assertWrites(puts=1, deletes=0)
+
+    def testUnregisterWritesOnce(self):
+        self.register(self.api.registerForConference)
+        self.assertTrue(self.register(self.api.unregisterFromConference).data)
+        # seat shard, and the Registration deleted
+        self.assertWrites(puts=1, deletes=1)
+
+    def testWishlistToggleWritesOnce(self):
+        self.assertTrue(self.wishlist(self.api.addSessionToWishlist).data)
+        # WishlistEntry and wishlist shard
+        self.assertWrites(puts=1, deletes=0)
+        self.assertTrue(self.wishlist(self.api.deleteSessionFromWishlist).data)
+        # wishlist shard, and the WishlistEntry deleted
+        self.assertWrites(puts=1, deletes=1)
+
+    def testSaveProfileWritesOnce(self):
+        self.call(self.api.saveProfile,
+                  ProfileMiniForm(displayName='Renamed', teeShirtSize=TeeShirtSize.XS_M),
+                  self.EMAIL)
+        self.assertWrites(puts=1, deletes=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
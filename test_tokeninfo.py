@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_tokeninfo.py
+
+Tests of the cached tokeninfo lookup of utils.py against a local
+urlfetch stub, so no request leaves the machine. Needs the App Engine
+SDK on sys.path.
+
+usage: python -m unittest test_tokeninfo
+
+"""
+
+import hashlib
+import json
+import os
+import unittest
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+os.environ.setdefault('APPLICATION_ID', 'dev~test')
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+import utils
+
+TOKEN = 'ya29.token'
+
+
+class TokeninfoStub(apiproxy_stub.APIProxyStub):
+
+    """TokeninfoStub -- urlfetch stub answering every fetch alike"""
+
+    def __init__(self):
+        super(TokeninfoStub, self).__init__('urlfetch')
+        self.status = 200
+        self.content = ''
+        self.fetches = 0
+
+    def _Dynamic_Fetch(self, request, response):
+        self.fetches += 1
+        response.set_statuscode(self.status)
+        response.set_content(self.content)
+
+
+class TokeninfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        self.bed.init_memcache_stub()
+        self.stub = TokeninfoStub()
+        apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', self.stub)
+        utils._token_cache.clear()
+
+    def tearDown(self):
+        utils._token_cache.clear()
+        self.bed.deactivate()
+
+    def lookup(self):
+        return utils._getTokenUserId(TOKEN, ['id_token', 'access_token'])
+
+    def cached(self):
+        return memcache.get(utils.TOKENINFO_CACHE_KEY
+                            % hashlib.sha256(TOKEN).hexdigest())
+
+    def lookupOnOtherInstance(self):
+        utils._token_cache.clear()
+        self.stub.fetches = 0
+        return self.lookup()
+
+    def testValidTokenIsCached(self):
+        self.stub.content = json.dumps({'user_id': '1234', 'expires_in': 600})
+        self.assertEqual(self.lookup(), '1234')
+        self.assertEqual(self.cached()[0], '1234')
+        self.assertEqual(self.lookupOnOtherInstance(), '1234')
+        self.assertEqual(self.stub.fetches, 0)
+
+    def testInvalidTokenIsCached(self):
+        self.stub.status = 400
+        self.stub.content = json.dumps({'error': 'invalid_token'})
+        self.assertEqual(self.lookup(), '')
+        self.assertEqual(self.cached()[0], '')
+        self.assertEqual(self.lookupOnOtherInstance(), '')
+        self.assertEqual(self.stub.fetches, 0)
+
+    def testFailedLookupIsNotShared(self):
+        self.stub.status = 503
+        self.assertEqual(self.lookup(), '')
+        self.assertIsNone(self.cached())
+        # backed off on this instance
+        self.stub.fetches = 0
+        self.assertEqual(self.lookup(), '')
+        self.assertEqual(self.stub.fetches, 0)
+        # looked up again elsewhere, where it now succeeds
+        self.stub.status = 200
+        self.stub.content = json.dumps({'user_id': '1234', 'expires_in': 600})
+        self.assertEqual(self.lookupOnOtherInstance(), '1234')
+        self.assertTrue(self.stub.fetches)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""unitofwork.py
+
+Write coalescing for ConferenceApi methods and transactions. Entities
+are marked dirty on a UnitOfWork as they change, however often, and
+written with one put_multi (and keys deleted with one delete_multi)
+when it is flushed.
+
+Methods decorated with withUnitOfWork get one for the request, flushed
+when the method returns; a method can start the flush early with
+flushAsync() so the writes overlap building the response. Transactional
+helpers use their own unit as a context manager, which flushes inside
+the transaction and discards the writes if the block raises.
+
+"""
+
+import functools
+import threading
+
+from google.appengine.ext import ndb
+
+_local = threading.local()
+
+
+class UnitOfWork(object):
+
+    """UnitOfWork -- entities to put and keys to delete, written in one batch"""
+
+    def __init__(self):
+        self._puts = []
+        self._deletes = []
+        self._futures = []
+
+    def put(self, *entities):
+        """Mark entities dirty; each is written once however often marked."""
+        for entity in entities:
+            if not any(entity is dirty for dirty in self._puts):
+                self._puts.append(entity)
+
+    def delete(self, *keys):
+        for key in keys:
+            if key not in self._deletes:
+                self._deletes.append(key)
+
+    def flushAsync(self):
+        """Start writing the pending changes without waiting for them."""
+        if self._puts:
+            self._futures.extend(ndb.put_multi_async(self._puts))
+        if self._deletes:
+            self._futures.extend(ndb.delete_multi_async(self._deletes))
+        self._puts, self._deletes = [], []
+
+    def flush(self):
+        """Write the pending changes and wait for all writes started."""
+        self.flushAsync()
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.get_result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        return False
+
+
+def current():
+    """Return the unit of work of the running request."""
+    uow = getattr(_local, 'uow', None)
+    if uow is None:
+        raise RuntimeError('No unit of work; decorate the method with '
+                           'withUnitOfWork')
+    return uow
+
+
+def withUnitOfWork(method):
+    """Run an endpoints method with its own UnitOfWork, flushed when the
+    method returns; changes are dropped if it raises."""
+    @functools.wraps(method)
+    def wrapper(self, request):
+        previous = getattr(_local, 'uow', None)
+        _local.uow = UnitOfWork()
+        try:
+            with _local.uow:
+                return method(self, request)
+        finally:
+            _local.uow = previous
+    return wrapper
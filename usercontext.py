@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""usercontext.py
+
+Request-scoped identity and Profile for ConferenceApi methods. Methods
+decorated with withUserContext get a UserContext that resolves the
+current user, user id and Profile at most once per request, however
+many helpers ask for them.
+
+"""
+
+import functools
+import threading
+
+import endpoints
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import TeeShirtSize
+from utils import getUserId
+
+_local = threading.local()
+
+
+class UserContext(object):
+
+    """UserContext -- current user, user id and Profile of one request"""
+
+    def __init__(self):
+        self._user = None
+        self._user_id = None
+        self._profile = None
+
+    def user(self):
+        """Return the current user, raising if not signed in."""
+        if self._user is None:
+            self._user = endpoints.get_current_user()
+            if not self._user:
+                raise endpoints.UnauthorizedException('Authorization required')
+        return self._user
+
+    def userId(self):
+        """Return the id of the current user."""
+        if self._user_id is None:
+            self._user_id = getUserId(self.user())
+        return self._user_id
+
+    def profileKey(self):
+        return ndb.Key(Profile, self.userId())
+
+    def profile(self, forUpdate=False):
+        """Return user Profile from datastore, creating new one if non-existent.
+
+        With forUpdate the Profile is read again inside the current
+        transaction, so it can be modified and put safely; the cached copy
+        is replaced once that transaction commits."""
+        if self._profile is not None and not (forUpdate and ndb.in_transaction()):
+            return self._profile
+
+        p_key = self.profileKey()
+        profile = p_key.get()
+        # create new Profile if not there
+        if not profile:
+            user = self.user()
+            profile = Profile(
+                key = p_key,
+                displayName = user.nickname(),
+                mainEmail= user.email(),
+                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
+            )
+            profile.put()
+
+        if ndb.in_transaction():
+            ndb.get_context().call_on_commit(lambda: self._setProfile(profile))
+        else:
+            self._profile = profile
+        return profile
+
+    def _setProfile(self, profile):
+        self._profile = profile
+
+
+def current():
+    """Return the context of the running request; outside of a decorated
+    method a fresh context is returned that isn't shared."""
+    return getattr(_local, 'context', None) or UserContext()
+
+
+def withUserContext(method):
+    """Run an endpoints method with its own UserContext."""
+    @functools.wraps(method)
+    def wrapper(self, request):
+        previous = getattr(_local, 'context', None)
+        _local.context = UserContext()
+        try:
+            return method(self, request)
+        finally:
+            _local.context = previous
+    return wrapper
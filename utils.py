@@ -1,13 +1,84 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import os
 import time
 import uuid
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from models import Profile
 
+from caching import LRUCache
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_CACHE_KEY = 'TOKENINFO_%s'
+TOKENINFO_DEADLINE = 5
+TOKENINFO_ATTEMPTS = 2
+# cache times in seconds; valid tokens are cached until they expire
+MAX_TOKEN_CACHE_TIME = 3600
+INVALID_TOKEN_CACHE_TIME = 300
+FAILED_LOOKUP_CACHE_TIME = 5
+
+_token_cache = LRUCache(1000)
+
+
+def _fetchTokenUserId(token, token_types):
+    """Look the token up at the tokeninfo endpoint, trying all token
+    types concurrently; return (user_id, seconds to cache the result),
+    user_id None if the lookup failed rather than the token."""
+    for attempt in range(TOKENINFO_ATTEMPTS):
+        rpcs = []
+        for token_type in token_types:
+            rpc = urlfetch.create_rpc(deadline=TOKENINFO_DEADLINE)
+            urlfetch.make_fetch_call(rpc, TOKENINFO_URL % (token_type, token))
+            rpcs.append(rpc)
+        invalid = 0
+        for rpc in rpcs:
+            try:
+                resp = rpc.get_result()
+            except urlfetch.Error:
+                continue
+            if resp.status_code == 200:
+                info = json.loads(resp.content)
+                expires_in = int(info.get('expires_in', MAX_TOKEN_CACHE_TIME))
+                return (info.get('user_id', ''),
+                        max(0, min(expires_in, MAX_TOKEN_CACHE_TIME)))
+            elif resp.status_code == 400 and 'invalid_token' in resp.content:
+                invalid += 1
+        if invalid == len(rpcs):
+            return '', INVALID_TOKEN_CACHE_TIME
+    # tokeninfo is failing; None tells the caller not to share this
+    return None, FAILED_LOOKUP_CACHE_TIME
+
+
+def _getTokenUserId(token, token_types):
+    """Return the user id for a bearer token, cached in the instance and
+    in memcache under a hash of the token; invalid tokens are cached too,
+    failed lookups only in the instance."""
+    key = TOKENINFO_CACHE_KEY % hashlib.sha256(token).hexdigest()
+    user_id = _token_cache.get(key)
+    if user_id is not None:
+        return user_id
+    cached = memcache.get(key)
+    if cached is not None:
+        user_id, expires = cached
+        _token_cache.set(key, user_id, max(0, expires - time.time()))
+        return user_id
+
+    user_id, cache_time = _fetchTokenUserId(token, token_types)
+    if user_id is None:
+        # a transient failure of this instance; back off briefly here
+        # instead of sleeping in the request, but keep it out of memcache
+        # so other instances don't reject the token too
+        _token_cache.set(key, '', cache_time)
+        return ''
+    if cache_time:
+        _token_cache.set(key, user_id, cache_time)
+        memcache.set(key, (user_id, time.time() + cache_time), time=cache_time)
+    return user_id
+
 
 def getUserId(user, id_type='email'):
     if id_type == 'email':
@@ -16,27 +87,12 @@ def getUserId(user, id_type='email'):
     if id_type == 'oauth':
         auth = os.getenv('HTTP_AUTHORIZATION')
         (bearer, token) = auth.split()
-        token_type = 'id_token'
+        # an id_token may also turn out to be an access_token; look up
+        # both at once rather than one after the other
+        token_types = ['id_token', 'access_token']
         if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s' \
-            % (token_type, token)
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' \
-                in resp.content:
-                url = \
-                    'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s' \
-                    % ('access_token', token)
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+            token_types = ['access_token']
+        return _getTokenUserId(token, token_types)
 
     if id_type == 'custom':
 